@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Benchmark de concurrence pour utils/quota.
+
+Lance des milliers d'incréments concurrents sur de nombreux utilisateurs
+simulés, contre une base temporaire, et mesure :
+- le débit (opérations/s) et la latence p50/p99
+- les mises à jour perdues (succès accordés mais absents de la base)
+- les dépassements de limite (plus de succès que daily_limit pour un utilisateur)
+
+Résultats en JSON (stdout ou --output) pour comparer les versions du store.
+
+    python bench_quota.py --users 200 --ops 5000 --limit 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from collections import Counter
+
+from utils.quota import QuotaStore, increment_if_under_limit, init_quota_db, _today_str
+
+TZ = "UTC"
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, int(round(pct / 100 * (len(values) - 1)))))
+    return values[idx]
+
+
+def _db_counts(db_path):
+    day = _today_str(TZ)
+    with sqlite3.connect(db_path) as db:
+        rows = db.execute("SELECT user_id, used FROM quotas WHERE day=?", (day,)).fetchall()
+    return {int(uid): int(used) for uid, used in rows}
+
+
+async def _run(name, op, user_ids, concurrency):
+    """Exécute `op(user_id)` pour chaque id, au plus `concurrency` à la fois."""
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+    granted = Counter()
+    errors = 0
+
+    async def one(uid):
+        nonlocal errors
+        async with sem:
+            t0 = time.perf_counter()
+            try:
+                ok = await op(uid)
+            except Exception:
+                errors += 1
+                ok = False
+            latencies.append(time.perf_counter() - t0)
+            if ok:
+                granted[uid] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(uid) for uid in user_ids))
+    elapsed = time.perf_counter() - start
+    return {
+        "name": name,
+        "elapsed_s": round(elapsed, 4),
+        "ops_per_s": round(len(user_ids) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 3),
+        "errors": errors,
+    }, granted
+
+
+def _violations(granted, db_counts, limit):
+    lost = sum(max(n - db_counts.get(uid, 0), 0) for uid, n in granted.items())
+    # Un utilisateur en dépassement côté succès et côté base ne compte qu'une fois
+    over = {uid for uid, n in granted.items() if n > limit}
+    over |= {uid for uid, used in db_counts.items() if used > limit}
+    return {"lost_updates": lost, "over_limit_users": len(over), "granted": sum(granted.values())}
+
+
+async def bench_legacy(db_path, user_ids, limit, concurrency):
+    await init_quota_db(db_path)
+
+    async def op(uid):
+        ok, _, _, _ = await increment_if_under_limit(uid, limit, tz_name=TZ, db_path=db_path)
+        return ok
+
+    result, granted = await _run("increment_if_under_limit", op, user_ids, concurrency)
+    result.update(_violations(granted, _db_counts(db_path), limit))
+    return result
+
+
+async def bench_store(db_path, user_ids, limit, concurrency, pool_size):
+    store = QuotaStore(db_path, tz_name=TZ, pool_size=pool_size)
+    await store.open()
+
+    async def op(uid):
+        ok, _, _, _ = await store.increment(uid, limit)
+        return ok
+
+    try:
+        result, granted = await _run("QuotaStore.increment", op, user_ids, concurrency)
+    finally:
+        await store.close()
+    result.update(_violations(granted, _db_counts(db_path), limit))
+    return result
+
+
+async def bench_reserve(db_path, user_ids, limit, concurrency, pool_size):
+    store = QuotaStore(db_path, tz_name=TZ, pool_size=pool_size)
+    await store.open()
+
+    async def op(uid):
+        res = await store.reserve(uid, limit, nbytes=1024)
+        if not res.ok:
+            return False
+        # Un job sur dix échoue et rend son quota
+        if random.random() < 0.1:
+            await store.refund(res.token)
+            return False
+        await store.commit(res.token)
+        return True
+
+    try:
+        result, granted = await _run("QuotaStore.reserve", op, user_ids, concurrency)
+    finally:
+        await store.close()
+    result.update(_violations(granted, _db_counts(db_path), limit))
+    return result
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=200, help="simulated users")
+    parser.add_argument("--ops", type=int, default=5000, help="total increments")
+    parser.add_argument("--limit", type=int, default=10, help="daily_limit per user")
+    parser.add_argument("--concurrency", type=int, default=500, help="in-flight operations")
+    parser.add_argument("--pool-size", type=int, default=4, help="QuotaStore pool size")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--skip-legacy", action="store_true", help="skip increment_if_under_limit")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    user_ids = [rng.randrange(args.users) for _ in range(args.ops)]
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="quota_bench_") as tmp:
+        if not args.skip_legacy:
+            results.append(await bench_legacy(
+                os.path.join(tmp, "legacy.db"), user_ids, args.limit, args.concurrency))
+        results.append(await bench_store(
+            os.path.join(tmp, "store.db"), user_ids, args.limit, args.concurrency, args.pool_size))
+        results.append(await bench_reserve(
+            os.path.join(tmp, "reserve.db"), user_ids, args.limit, args.concurrency, args.pool_size))
+
+    report = {
+        "params": {
+            "users": args.users,
+            "ops": args.ops,
+            "limit": args.limit,
+            "concurrency": args.concurrency,
+            "pool_size": args.pool_size,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
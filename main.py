@@ -14,13 +14,29 @@ from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from collections import defaultdict
 from telethon import TelegramClient, events, Button
-from telethon.tl.types import DocumentAttributeFilename, DocumentAttributeVideo, ReplyKeyboardForceReply
-from telethon.errors import FloodWaitError, UserNotParticipantError, ChannelPrivateError
+from telethon.tl.types import DocumentAttributeFilename, DocumentAttributeVideo, ReplyKeyboardForceReply, UpdateChannelParticipant
+from telethon.tl.types import InputChannel, InputPeerChannel
+from telethon.errors import FloodWaitError, UserNotParticipantError, ChannelPrivateError, ChannelInvalidError
 from telethon.tl.functions.messages import SetTypingRequest
 from telethon.tl.types import SendMessageTypingAction, SendMessageUploadDocumentAction
 from telethon.tl.functions.channels import GetParticipantRequest
 import logging
-from utils.quota import increment_if_under_limit
+from utils.quota import QuotaStore, DB_PATH as QUOTA_DB_PATH
+from utils.userstore import UserStore
+from utils.statefile import StateFileWriter, write_json_atomic
+from utils.stats import RenameStats
+from utils.media import (
+    MediaInfo, FFmpegExecutor, info_from_document, probe_media, probe_head,
+    normalize_thumbnail, can_normalize_thumbnails,
+)
+from utils.transfer import (
+    pipe_document, download_parallel, upload_file_parallel, upload_stream, iter_document,
+    ThumbCache, is_expired_upload_error, PARALLEL_MIN_SIZE,
+)
+from utils.forcejoin import (
+    ChannelRegistry, MembershipCache, LiveMembership, participant_is_member, clean_channel,
+    CHECK_CONCURRENCY, CHECK_TIMEOUT,
+)
 from dotenv import load_dotenv
 
 # Load environment variables from .env if present
@@ -28,6 +44,8 @@ load_dotenv()
 # Configuration des quotas
 DAILY_LIMIT = int(os.getenv("DAILY_LIMIT", "10"))
 QUOTA_TZ = os.getenv("QUOTA_TZ", "UTC")
+# Long-lived quota store (connection pool opened once at startup)
+quota_store = QuotaStore(QUOTA_DB_PATH, tz_name=QUOTA_TZ)
 # Upload queue and worker system
 UPLOAD_QUEUE = asyncio.Queue()
 UPLOAD_SEMAPHORE = asyncio.Semaphore(1)  # 1 upload at a time
@@ -67,6 +85,8 @@ async def safe_send_file(client, chat_id, file, **kwargs):
             await asyncio.sleep(wait_time)
             retry_count += 1
         except Exception as e:
+            if is_expired_upload_error(e):
+                raise  # Same handle would fail again; the caller re-uploads
             logging.error(f"Error sending file: {e}")
             await asyncio.sleep(2)
             retry_count += 1
@@ -198,13 +218,25 @@ def _parse_admin_ids(s: str):
     return ids
 
 ADMIN_SET = _parse_admin_ids(ADMIN_IDS)
+# Shared debounced writer for JSON state files (atomic temp file + os.replace)
+state_writer = StateFileWriter()
 BASE_DIR = Path(__file__).resolve().parent
 FJ_PATH = BASE_DIR / "force_join_channels.json"
 fj_lock = asyncio.Lock()
+# Forced channels cached in memory; reloaded only when the file's mtime changes
+fj_registry = ChannelRegistry(FJ_PATH, state_writer)
+# Membership results per (user, channel): FJ_POSITIVE_TTL / FJ_NEGATIVE_TTL seconds
+membership_cache = MembershipCache()
+# Live membership for forced channels where the bot is admin (fed by participant updates)
+live_membership = LiveMembership()
+# Forced channel name -> InputChannel (persisted in force_join_channels.json under "resolved")
+input_channels = {}
+# Bounds concurrent GetParticipantRequest calls across all users
+fj_check_sem = asyncio.Semaphore(max(1, CHECK_CONCURRENCY))
 
 def _ensure_fj_file():
     if not FJ_PATH.exists():
-        FJ_PATH.write_text(json.dumps({"channels": []}, ensure_ascii=False, indent=2), encoding="utf-8")
+        write_json_atomic(FJ_PATH, {"channels": []})
 
 def _normalize_channel(ref: str) -> str:
     ref = (ref or "").strip()
@@ -239,49 +271,23 @@ async def load_fj_channels() -> list:
         return []
 
 async def save_fj_channels(channels: list) -> None:
-    _ensure_fj_file()
-    FJ_PATH.write_text(json.dumps({"channels": channels}, ensure_ascii=False, indent=2), encoding="utf-8")
+    fj_registry.set(channels)
 
 def get_forced_channels() -> list:
-    """Get list of forced channels"""
-    data = _load_json(FJ_PATH, {"channels": []})
-    chans = []
-    for ch in data.get("channels", []):
-        c = str(ch).strip().lstrip("@").lstrip("#")
-        if c and c not in chans:
-            chans.append(c)
-    data["channels"] = chans
-    _save_json(FJ_PATH, data)
-    return chans
+    """Get list of forced channels (in-memory; never writes)"""
+    return fj_registry.channels()
 
 def set_forced_channels(channels: list):
     """Set forced channels list"""
-    norm = []
-    for ch in channels:
-        c = str(ch).strip().lstrip("@").lstrip("#")
-        if c and c not in norm:
-            norm.append(c)
-    _save_json(FJ_PATH, {"channels": norm})
+    fj_registry.set(channels)
 
 def add_forced_channels(channels: list) -> list:
     """Add channels to forced list"""
-    current = set(get_forced_channels())
-    for ch in channels:
-        c = str(ch).strip().lstrip("@").lstrip("#")
-        if c:
-            current.add(c)
-    set_forced_channels(list(current))
-    return get_forced_channels()
+    return fj_registry.add(channels)
 
 def del_forced_channels(channels: list) -> list:
     """Remove channels from forced list"""
-    current = set(get_forced_channels())
-    for ch in channels:
-        c = str(ch).strip().lstrip("@").lstrip("#")
-        if c in current:
-            current.remove(c)
-    set_forced_channels(list(current))
-    return get_forced_channels()
+    return fj_registry.remove(channels)
 
 def _load_json(path, default):
     """Load JSON file"""
@@ -293,14 +299,6 @@ def _load_json(path, default):
         pass
     return default
 
-def _save_json(path, data):
-    """Save JSON file"""
-    try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-    except Exception as e:
-        logging.error(f"Error saving {path.name}: {e}")
-
 # Configuration
 MAX_FILE_SIZE = 2000 * 1024 * 1024  # 2 GB
 TEMP_DIR = "temp_files"
@@ -309,6 +307,17 @@ DOWNLOAD_DIR = "downloads"  # New directory to store files
 USER_TIMEOUT = 600  # 10 minutes
 PROGRESS_UPDATE_INTERVAL = 8  # seconds (réduit la fréquence de mise à jour pour améliorer la vitesse)
 MAX_THUMB_SIZE = 200 * 1024  # 200 KB
+MAX_THUMB_INPUT_SIZE = 10 * 1024 * 1024  # photos accepted by /setthumb when they get normalized
+COMPAT_CONVERT_MAX_BYTES = 100 * 1024 * 1024  # larger videos are never converted
+# Thumbnail jobs that need no ffmpeg are piped Telegram -> Telegram without a temp file
+STREAM_PIPE = os.getenv("STREAM_PIPE", "1") != "0"
+# Videos too large to convert on disk are converted on the fly (download | ffmpeg | upload)
+STREAM_TRANSCODE = os.getenv("STREAM_TRANSCODE", "1") != "0"
+STREAM_PROBE_PARTS = 4  # first 2 MB are enough for ffprobe to see the codecs
+# Async ffmpeg jobs: FFMPEG_SLOTS concurrent encodes, FFMPEG_THREADS each, FFMPEG_TIMEOUT seconds
+media_jobs = FFmpegExecutor()
+# Uploaded thumbnail handles per user, keyed by thumb content hash
+thumb_cache = ThumbCache()
 
 # New limits
 DAILY_LIMIT_GB = 2  # 2 GB per day per user
@@ -326,39 +335,19 @@ os.makedirs(TEMP_DIR, exist_ok=True)
 os.makedirs(THUMBNAIL_DIR, exist_ok=True)
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)  # New directory
 
-# Initialize the Telethon client
-bot = TelegramClient('rename_bot', API_ID, API_HASH).start(bot_token=TOKEN)
+# Initialize the Telethon client (connected in __main__ once state is warmed up)
+bot = TelegramClient('rename_bot', API_ID, API_HASH)
 
 # Rename stats (JSON local)
 RENAME_STATS_PATH = os.path.join(os.path.dirname(__file__), 'rename_stats.json')
-_rename_lock = asyncio.Lock()
-
-def _ensure_rename_stats_file():
-    if not os.path.exists(RENAME_STATS_PATH):
-        with open(RENAME_STATS_PATH, 'w', encoding='utf-8') as f:
-            json.dump({"total_files_renamed": 0, "total_storage_bytes": 0}, f, ensure_ascii=False, indent=2)
+# In-memory counters + hourly/daily buckets, flushed periodically through state_writer
+rename_stats = RenameStats(RENAME_STATS_PATH, state_writer)
 
 async def load_rename_stats() -> dict:
-    _ensure_rename_stats_file()
-    try:
-        with open(RENAME_STATS_PATH, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception:
-        return {"total_files_renamed": 0, "total_storage_bytes": 0}
+    return rename_stats.to_dict()
 
 async def add_rename_stat(file_size_bytes: int) -> None:
-    _ensure_rename_stats_file()
-    async with _rename_lock:
-        try:
-            with open(RENAME_STATS_PATH, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        except Exception:
-            data = {"total_files_renamed": 0, "total_storage_bytes": 0}
-        data["total_files_renamed"] = int(data.get("total_files_renamed", 0)) + 1
-        inc = int(file_size_bytes or 0)
-        data["total_storage_bytes"] = int(data.get("total_storage_bytes", 0)) + max(0, inc)
-        with open(RENAME_STATS_PATH, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+    rename_stats.record(file_size_bytes)
 
 # Dictionary to store user sessions (legacy: single active)
 user_sessions = {}
@@ -375,14 +364,21 @@ async def cleanup_old_messages():
     try:
         now = datetime.now()
         to_delete = []
+        # A file still waiting on a rename/thumbnail prompt keeps its entry and token
+        prompted = {s.get('storage_key') for s in user_sessions.values() if isinstance(s, dict)}
         for key, data in list(ORIGINAL_MESSAGES.items()):
             ts = data.get('timestamp')
-            if not ts:
+            if not ts or key in prompted:
                 continue
             if (now - ts).total_seconds() > MESSAGE_CLEANUP_TIME:
                 to_delete.append(key)
         for k in to_delete:
-            ORIGINAL_MESSAGES.pop(k, None)
+            data = ORIGINAL_MESSAGES.pop(k, None) or {}
+            # A queued/running thumbnail job owns its token (commit or refund)
+            if data.get('in_flight'):
+                continue
+            # File was never processed: the action stays charged, no bytes were used
+            await quota_store.commit(data.get('quota_token'), nbytes=0)
         if to_delete:
             logging.info(f"Cleaned {len(to_delete)} old message references")
     except Exception as e:
@@ -440,12 +436,11 @@ async def _thumb_worker(user_id: int, q: asyncio.Queue):
     finally:
         THUMB_WORKERS.pop(user_id, None)
 
-# Usage limits system
-user_usage = defaultdict(lambda: {'daily_bytes': 0, 'last_reset': None, 'last_file_time': None})
-usage_file = "user_usage.json"
+# Usage limits system: bytes, actions and cooldown all live in quota_store
 
-# User preferences system
-sessions = {}  # To store user preferences
+# User preferences system (SQLite, one row per user, loaded eagerly at startup)
+user_store = UserStore()
+sessions = user_store.cache  # To store user preferences
 
 # HELPER FUNCTION TO GET LOCAL FILE PATH
 def get_local_file_path(user_id, file_id, extension):
@@ -455,8 +450,11 @@ def get_local_file_path(user_id, file_id, extension):
     return os.path.join(user_dir, f"{file_id}{extension}")
 
 # 🔥 FORCE JOIN CHANNEL FUNCTIONS 🔥 (multi-channel)
-async def is_user_in_required_channels(user_id):
-    """Return (ok, missing_list). Admins bypass. If no JSON channels, fallback to FORCE_JOIN_CHANNEL."""
+async def is_user_in_required_channels(user_id, fresh=False):
+    """Return (ok, missing_list). Admins bypass. If no JSON channels, fallback to FORCE_JOIN_CHANNEL.
+
+    Results are cached per (user, channel); fresh=True skips the cache (used by "I have joined").
+    """
     if user_id in ADMIN_SET:
         return True, []
     channels = get_forced_channels()
@@ -465,19 +463,107 @@ async def is_user_in_required_channels(user_id):
         channels = [FORCE_JOIN_CHANNEL] if FORCE_JOIN_CHANNEL else []
         if not channels:
             return True, []
-    missing = []
+    joined = {}
+    to_check = []
     for ch in channels:
+        cached = None
+        if not fresh:
+            cached = live_membership.get(user_id, ch)
+            if cached is None and not live_membership.is_watched(ch):
+                cached = membership_cache.get(user_id, ch)
+        if cached is None:
+            to_check.append(ch)
+        else:
+            joined[ch] = cached
+    if to_check:
+        # One round-trip of latency whatever the channel count
+        results = await asyncio.gather(*(_check_channel_member(user_id, ch) for ch in to_check))
+        joined.update(zip(to_check, results))
+    missing = [ch for ch in channels if not joined.get(ch)]
+    return (len(missing) == 0), missing
+
+async def _check_channel_member(user_id, ch):
+    """One GetParticipantRequest, bounded by fj_check_sem and CHECK_TIMEOUT. Errors count as not joined."""
+    try:
+        async with fj_check_sem:
+            await asyncio.wait_for(_get_participant(user_id, ch), timeout=CHECK_TIMEOUT)
+        _remember_membership(user_id, ch, True)
+        return True
+    except UserNotParticipantError:
+        _remember_membership(user_id, ch, False)
+        return False
+    except ChannelPrivateError:
+        # Config problem, not the user's: don't cache
+        logging.error(f"No access to channel {ch}")
+        return False
+    except asyncio.TimeoutError:
+        logging.warning(f"Channel verification timed out for {ch} after {CHECK_TIMEOUT}s")
+        return False
+    except Exception as e:
+        logging.error(f"Channel verification error for {ch}: {e}")
+        return False
+
+async def _get_participant(user_id, ch):
+    channel = await resolve_forced_channel(ch)
+    try:
+        return await bot(GetParticipantRequest(channel=channel, participant=user_id))
+    except ChannelInvalidError:
+        # Stale access hash: resolve the username again, once
+        channel = await resolve_forced_channel(ch, force=True)
+        return await bot(GetParticipantRequest(channel=channel, participant=user_id))
+
+def _channel_ref(ch):
+    ref = clean_channel(ch)
+    return int(ref) if ref.lstrip('-').isdigit() else ref
+
+async def resolve_forced_channel(ch, force=False):
+    """InputChannel for a forced channel. The username is resolved only when unknown or when force=True"""
+    key = clean_channel(ch)
+    if not force:
+        channel = input_channels.get(key)
+        if channel is not None:
+            return channel
+        ref = fj_registry.resolved(key)
+        if ref:
+            input_channels[key] = InputChannel(*ref)
+            return input_channels[key]
+        peer = await bot.get_input_entity(_channel_ref(key))
+        if not isinstance(peer, InputPeerChannel):
+            raise ValueError(f"{ch} is not a channel")
+        channel_id, access_hash = peer.channel_id, peer.access_hash
+    else:
+        # get_entity() asks Telegram again instead of trusting the session cache
+        entity = await bot.get_entity(_channel_ref(key))
+        channel_id, access_hash = entity.id, entity.access_hash
+    input_channels[key] = InputChannel(channel_id, access_hash)
+    fj_registry.set_resolved(key, channel_id, access_hash)
+    return input_channels[key]
+
+def _remember_membership(user_id, ch, member):
+    # Watched channels get pushed updates, so no TTL is needed there
+    if live_membership.is_watched(ch):
+        live_membership.record(user_id, ch, member)
+    else:
+        membership_cache.set(user_id, ch, member)
+
+async def refresh_live_membership():
+    """Resolve the forced channels and watch those where the bot is admin; the others stay on RPC + TTL cache"""
+    watched = {}
+    for ch in get_forced_channels():
         try:
-            await bot(GetParticipantRequest(channel=ch, participant=user_id))
-        except UserNotParticipantError:
-            missing.append(ch)
-        except ChannelPrivateError:
-            logging.error(f"No access to channel {ch}")
-            missing.append(ch)
+            channel = await resolve_forced_channel(ch)
+            perms = await bot.get_permissions(channel, 'me')
+            if perms.is_admin:
+                watched[ch] = channel.channel_id
         except Exception as e:
-            logging.error(f"Channel verification error for {ch}: {e}")
-            missing.append(ch)
-    return (len(missing) == 0), missing
+            logging.warning(f"Could not check admin rights in {ch}: {e}")
+    live_membership.set_watched(watched)
+    logging.info(f"Live membership: watching {len(watched)} channel(s)")
+
+@bot.on(events.Raw(UpdateChannelParticipant))
+async def channel_participant_handler(update):
+    """Joins and leaves pushed by Telegram for channels where the bot is admin"""
+    live_membership.apply(update.channel_id, update.user_id, participant_is_member(update.new_participant))
 
 async def send_force_join_message(event, missing_channels=None):
     """Sends the message asking the user to join required channels"""
@@ -554,6 +640,7 @@ async def addfsub_cmd(event):
     chans = [x for x in (s.lstrip("@").lstrip("#") for s in raw) if x]
     new_list = add_forced_channels(chans)
     await event.reply("✅ Forced-sub channels updated:\n" + "\n".join(f"• @{c}" for c in new_list))
+    await refresh_live_membership()
 
 
 @bot.on(events.NewMessage(pattern=r"/delfsub(?:\s+.*)?"))
@@ -566,11 +653,13 @@ async def delfsub_cmd(event):
     parts = text.split(maxsplit=1)
     if len(parts) < 2 or not parts[1].strip():
         set_forced_channels([])
+        live_membership.set_watched({})
         await event.reply("✅ All forced-sub channels removed.")
         return
     raw = re.split(r"[,\s]+", parts[1].strip())
     chans = [x for x in (s.lstrip("@").lstrip("#") for s in raw) if x]
     new_list = del_forced_channels(chans)
+    await refresh_live_membership()
     if new_list:
         await event.reply("✅ Remaining forced-sub channels:\n" + "\n".join(f"• @{c}" for c in new_list))
     else:
@@ -606,34 +695,9 @@ async def broadcast_cmd(event):
 
     broadcast_msg = parts[1].strip()
 
-    # Get all unique user IDs from user_usage
+    # Audience = user registry (one row per user)
     try:
-        all_users = set()
-
-        # Load from user_usage.json
-        if os.path.exists(usage_file):
-            with open(usage_file, 'r') as f:
-                data = json.load(f)
-                all_users.update(int(uid) for uid in data.keys())
-
-        # Load from user_preferences.json
-        if os.path.exists('user_preferences.json'):
-            with open('user_preferences.json', 'r') as f:
-                data = json.load(f)
-                all_users.update(int(uid) for uid in data.keys())
-
-        # Load from quota database
-        try:
-            import aiosqlite
-            db_path = os.getenv("QUOTA_DB_PATH", "quota.db")
-            if os.path.exists(db_path):
-                async with aiosqlite.connect(db_path) as db:
-                    cur = await db.execute("SELECT DISTINCT user_id FROM quotas")
-                    rows = await cur.fetchall()
-                    await cur.close()
-                    all_users.update(row[0] for row in rows)
-        except Exception as e:
-            logging.warning(f"Could not load users from quota DB: {e}")
+        all_users = await user_store.user_ids()
 
         if not all_users:
             await event.reply("❌ No users found in database.")
@@ -726,113 +790,31 @@ def add_custom_text_to_filename(filename, custom_text=None, position='end'):
 
  
 
-def save_user_preferences():
-    """Saves user preferences"""
+async def touch_user(user_id):
+    """Record activity in the user registry (never blocks a handler on failure)"""
     try:
-        prefs = {}
-        for user_id, session in sessions.items():
-            if 'custom_text' in session or 'text_position' in session or 'clean_tags' in session:
-                prefs[str(user_id)] = {
-                    'custom_text': session.get('custom_text', ''),
-                    'text_position': session.get('text_position', 'end'),
-                    'clean_tags': session.get('clean_tags', True)
-                }
-        
-        with open('user_preferences.json', 'w') as f:
-            json.dump(prefs, f, indent=2)
+        await user_store.touch(user_id)
     except Exception as e:
-        logging.error(f"Error saving preferences: {e}")
+        logging.warning(f"Could not update last_active for {user_id}: {e}")
 
-def load_user_preferences():
-    """Loads user preferences"""
+async def save_user_preferences(user_id):
+    """Saves one user's preferences (only their row is written)"""
     try:
-        if os.path.exists('user_preferences.json'):
-            with open('user_preferences.json', 'r') as f:
-                prefs = json.load(f)
-                for user_id_str, pref_data in prefs.items():
-                    user_id = int(user_id_str)
-                    sessions[user_id] = pref_data
+        await user_store.save(user_id)
     except Exception as e:
-        logging.error(f"Error loading preferences: {e}")
-
-
-
-
-def load_user_usage():
-    """Loads usage data from the file"""
-    try:
-        if os.path.exists(usage_file):
-            with open(usage_file, 'r') as f:
-                data = json.load(f)
-                for user_id_str, usage_data in data.items():
-                    user_id = int(user_id_str)
-                    user_usage[user_id] = usage_data
-    except Exception as e:
-        logging.error(f"Error loading usage: {e}")
+        logging.error(f"Error saving preferences: {e}")
 
-def save_user_usage():
-    """Saves usage data to the file"""
-    try:
-        data = {}
-        for user_id, usage_data in user_usage.items():
-            data[str(user_id)] = usage_data
-        with open(usage_file, 'w') as f:
-            json.dump(data, f, indent=2)
-    except Exception as e:
-        logging.error(f"Error saving usage: {e}")
-
-def reset_daily_usage_if_needed(user_id):
-    """Resets daily usage if needed"""
-    now = datetime.now()
-    last_reset = user_usage[user_id].get('last_reset')
-    
-    if last_reset:
-        last_reset = datetime.fromisoformat(last_reset)
-        if now.date() > last_reset.date():
-            user_usage[user_id]['daily_bytes'] = 0
-            user_usage[user_id]['last_reset'] = now.isoformat()
-            logging.info(f"Daily reset for user {user_id}")
-    else:
-        user_usage[user_id]['last_reset'] = now.isoformat()
-
-def check_user_limits(user_id, file_size):
-    """Checks user limits"""
-    reset_daily_usage_if_needed(user_id)
-    
-    # Check daily limit
-    current_daily = user_usage[user_id]['daily_bytes']
-    if current_daily + file_size > DAILY_LIMIT_BYTES:
-        remaining = DAILY_LIMIT_BYTES - current_daily
-        return False, f"Daily limit reached! Used: {human_readable_size(current_daily)}/{human_readable_size(DAILY_LIMIT_BYTES)}. Remaining: {human_readable_size(remaining)}"
-    
-    # Check cooldown between files
-    last_file_time = user_usage[user_id].get('last_file_time')
-    if last_file_time:
-        last_file_time = datetime.fromisoformat(last_file_time)
-        time_since_last = (datetime.now() - last_file_time).total_seconds()
-        if time_since_last < COOLDOWN_SECONDS:
-            remaining_cooldown = COOLDOWN_SECONDS - time_since_last
-            return False, f"Please wait {int(remaining_cooldown)} seconds before the next file"
-    
-    return True, "OK"
-
-def update_user_usage(user_id, file_size):
-    """Updates user usage"""
-    user_usage[user_id]['daily_bytes'] += file_size
-    user_usage[user_id]['last_file_time'] = datetime.now().isoformat()
-    save_user_usage()
-
-def get_user_usage_info(user_id):
+async def get_user_usage_info(user_id):
     """Returns user usage information"""
-    reset_daily_usage_if_needed(user_id)
-    daily_used = user_usage[user_id]['daily_bytes']
-    daily_remaining = DAILY_LIMIT_BYTES - daily_used
+    usage = await quota_store.usage(user_id)
+    daily_used = usage['bytes']
+    daily_remaining = max(DAILY_LIMIT_BYTES - daily_used, 0)
     
     return {
         'daily_used': daily_used,
         'daily_remaining': daily_remaining,
         'daily_limit': DAILY_LIMIT_BYTES,
-        'percentage': (daily_used / DAILY_LIMIT_BYTES) * 100
+        'percentage': min((daily_used / DAILY_LIMIT_BYTES) * 100, 100.0)
     }
 
 async def cleanup_user_files(user_id):
@@ -942,68 +924,15 @@ def sanitize_filename(filename):
 
 
 
-def get_video_duration(file_path):
-    """Gets the duration of a video with ffprobe"""
-    try:
-        import subprocess
-        import json
-        
-        # If ffprobe is not available, return None
-        if not shutil.which("ffprobe"):
-            return None
-            
-        result = subprocess.run(
-            ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', file_path],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        
-        if result.returncode == 0:
-            data = json.loads(result.stdout)
-            duration = float(data.get('format', {}).get('duration', 0))
-            return int(duration)
-    except:
-        pass
-    return None
-
-def get_video_dimensions(file_path):
-    """Gets the dimensions of a video with ffprobe"""
-    try:
-        import subprocess
-        import json
-        
-        if not shutil.which("ffprobe"):
-            return None, None
-            
-        result = subprocess.run(
-            ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_streams', '-select_streams', 'v:0', file_path],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        
-        if result.returncode == 0:
-            data = json.loads(result.stdout)
-            streams = data.get('streams', [])
-            if streams:
-                width = streams[0].get('width', 0)
-                height = streams[0].get('height', 0)
-                return width, height
-    except:
-        pass
-    return None, None
-
-def get_video_attributes(file_path, sanitized_name):
-    """Create optimized video attributes for streaming"""
-    duration = get_video_duration(file_path)
-    width, height = get_video_dimensions(file_path)
+def get_video_attributes(sanitized_name, info=None):
+    """Create optimized video attributes for streaming from probed metadata"""
+    width = info.width if info else 0
+    height = info.height if info else 0
+    duration = int(info.duration) if info else 0
     
     # Default values if we cannot detect them
     if not width or not height:
         width, height = 1280, 720  # Default HD
-    if not duration:
-        duration = 0
     
     attributes = [
         DocumentAttributeFilename(sanitized_name),
@@ -1018,76 +947,101 @@ def get_video_attributes(file_path, sanitized_name):
     
     return attributes
 
-async def ensure_video_compatibility(file_path, progress_msg=None):
-    """Optimized version - avoid conversion unless absolutely necessary"""
+async def ensure_video_compatibility(file_path, progress_msg=None, info=None):
+    """Optimized version - avoid conversion unless absolutely necessary.
+
+    `info` is the MediaInfo from probe_media(); returns (path, info).
+    """
     
     # NEW: Check file size
     file_size = os.path.getsize(file_path)
-    if file_size > 100 * 1024 * 1024:  # If > 100 MB
+    if file_size > COMPAT_CONVERT_MAX_BYTES:  # If > 100 MB
         # Do NOT convert large files
-        return file_path
+        return file_path, info
     
     # Proceed for smaller files...
-    # Check codec with ffprobe
-    if not shutil.which("ffprobe"):
-        return file_path  # No ffprobe, keep the file as-is
+    # No metadata (no ffprobe, probe failed): keep the file as-is
+    if info is None or not media_jobs.available():
+        return file_path, info
+    
+    # Remux when the codecs are fine, transcode only the incompatible streams
+    plan = media_jobs.plan(info)
+    if plan is None:
+        return file_path, info
     
     try:
-        import subprocess
-        import json
+        if progress_msg:
+            label = "Remuxing video to MP4..." if media_jobs.is_remux(plan) else "Converting video for better compatibility..."
+            await safe_edit(progress_msg, label, parse_mode='html')
         
-        # Get codec information
-        result = subprocess.run(
-            ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_streams', file_path],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
+        output_path = f"{file_path}_converted.mp4"
+        await media_jobs.convert(file_path, output_path, plan)
         
-        if result.returncode == 0:
-            data = json.loads(result.stdout)
-            streams = data.get('streams', [])
-            
-            video_codec = None
-            audio_codec = None
-            
-            for stream in streams:
-                if stream['codec_type'] == 'video':
-                    video_codec = stream.get('codec_name', '')
-                elif stream['codec_type'] == 'audio':
-                    audio_codec = stream.get('codec_name', '')
-            
-            # If already H264/AAC, no need to convert
-            if video_codec == 'h264' and audio_codec == 'aac':
-                return file_path
-            
-            # Otherwise, convert
-            if progress_msg:
-                await safe_edit(progress_msg, "Converting video for better compatibility...", parse_mode='html')
-            
-            output_path = file_path.replace('.', '_converted.')
-            
-            # FFmpeg command optimized for Telegram
-            cmd = [
-                'ffmpeg', '-i', file_path,
-                '-c:v', 'libx264',           # Video codec H.264
-                '-c:a', 'aac',               # Audio codec AAC
-                '-preset', 'fast',           # Fast conversion
-                '-movflags', '+faststart',   # 
-                '-map', '0:v:0?',
-                '-map', '0:a:0?',
-                output_path
-            ]
-            
-            subprocess.run(cmd, check=True, capture_output=True)
-            
-            # Remove original and return converted
-            os.remove(file_path)
-            return output_path
+        # Remove original and return converted (same geometry, new codecs)
+        os.remove(file_path)
+        return output_path, info.after_transcode(plan)
             
     except Exception as e:
         logging.warning(f"Video conversion failed: {e}")
-        return file_path  # On error, keep the original
+        return file_path, info  # On error, keep the original
+
+async def probe_document_head(client, document, size, info=None):
+    """Probe the first parts of a Telegram document; returns (head bytes, MediaInfo).
+
+    Geometry/duration come from `info` (the Telegram attribute) when known,
+    codecs and container from the probe. Raises RuntimeError if ffprobe fails.
+    """
+    head = b''.join([chunk async for chunk in iter_document(client, document, size, limit=STREAM_PROBE_PARTS)])
+    probed = await probe_head(head)
+    if probed is None:
+        raise RuntimeError("could not probe the stream head")
+    return head, MediaInfo(
+        duration=(info.duration if info else 0) or probed.duration,
+        width=(info.width if info else 0) or probed.width,
+        height=(info.height if info else 0) or probed.height,
+        video_codec=probed.video_codec, audio_codec=probed.audio_codec,
+        format_name=probed.format_name, size=size,
+        supports_streaming=info.supports_streaming if info else False,
+        source=info.source if info else probed.source,
+    )
+
+async def stream_transcode_document(client, document, size, file_name, info, progress=None):
+    """Convert a Telegram document on the fly: download -> ffmpeg stdin, fragmented MP4 stdout -> upload.
+
+    `info` comes from the Telegram attribute and may be None (documents sent
+    without DocumentAttributeVideo): geometry and duration are then probed too.
+    Returns (InputFile, MediaInfo); InputFile is None when the codecs turn out
+    to be fine already.
+    """
+    head, info = await probe_document_head(client, document, size, info)
+    plan = media_jobs.plan(info)
+    if plan is None:
+        return None, info
+    logging.info(f"Stream-converting {file_name} ({plan}): {info.describe()}")
+    fed = 0
+    
+    async def source():
+        # The probed head is fed as is; the download resumes right after it
+        nonlocal fed
+        fed = len(head)
+        if progress:
+            await progress(fed, size)
+        yield head
+        if size and fed >= size:
+            return
+        async for chunk in iter_document(client, document, size, offset=fed):
+            fed += len(chunk)
+            if progress:
+                await progress(fed, size)
+            yield chunk
+    
+    args = media_jobs.build_args('pipe:0', 'pipe:1', plan, fragmented=True)
+    output = media_jobs.stream(args, source(), cpu=not media_jobs.is_remux(plan))
+    try:
+        input_file = await upload_stream(client, output, None, file_name)
+    finally:
+        await output.aclose()
+    return input_file, info.after_transcode(plan, size=size)
 
 async def progress_callback(current, total, event, start_time, progress_msg, action="Downloading", last_update_time=None):
     """Callback to display progress with styled format"""
@@ -1172,7 +1126,7 @@ async def clean_old_sessions():
 @bot.on(events.CallbackQuery(data="check_joined"))
 async def check_joined_handler(event):
     user_id = event.query.user_id
-    ok, missing = await is_user_in_required_channels(user_id)
+    ok, missing = await is_user_in_required_channels(user_id, fresh=True)
     if ok:
         await event.answer("✅ Thank you! You can now use the bot.", alert=True)
         await event.delete()
@@ -1195,14 +1149,8 @@ async def start_handler(event):
         await send_force_join_message(event, missing)
         return
     
-    # Load data if not already done
-    if not hasattr(start_handler, 'data_loaded'):
-        load_user_usage()
-        load_user_preferences()
-        start_handler.data_loaded = True
-    
     # Get usage information
-    usage_info = get_user_usage_info(user_id)
+    usage_info = await get_user_usage_info(user_id)
     
     # Check if user has a custom text
     custom_text = sessions.get(user_id, {}).get('custom_text', '')
@@ -1268,7 +1216,12 @@ async def cancel_handler(event):
                 os.remove(user_sessions[user_id]['temp_path'])
             except:
                 pass
-        del user_sessions[user_id]
+        sess = user_sessions.pop(user_id)
+        # A pending rename/thumbnail prompt holds a quota reservation: give it back
+        stored_data = sess.get('stored_data') or {}
+        if stored_data.get('quota_token'):
+            await quota_store.refund(stored_data['quota_token'])
+            ORIGINAL_MESSAGES.pop(sess.get('storage_key'), None)
         await event.reply("❌ <b>Operation cancelled.</b>", parse_mode='html')
     else:
         await event.reply("ℹ️ No active operation to cancel.")
@@ -1322,9 +1275,11 @@ async def status_handler(event):
         stats = await load_rename_stats()
         total_renamed = int(stats.get("total_files_renamed", 0))
         total_storage_used = float(stats.get("total_storage_bytes", 0.0))
+        trends = rename_stats.trends()
     except Exception:
         total_renamed = 0
         total_storage_used = 0.0
+        trends = {"files_last_hour": 0, "files_per_hour_24h": 0.0, "bytes_today": 0, "bytes_per_day_7d": 0.0}
 
     # User statistics
     total_users = 0
@@ -1335,54 +1290,13 @@ async def status_handler(event):
     custom_captions = 0
 
     try:
-        now = datetime.now()
-        all_users = set()
-
-        # Count users from user_usage.json
-        if os.path.exists(usage_file):
-            with open(usage_file, 'r') as f:
-                data = json.load(f)
-                all_users.update(int(uid) for uid in data.keys())
-                for uid_str, usage_data in data.items():
-                    last_file_time = usage_data.get('last_file_time')
-                    if last_file_time:
-                        try:
-                            last_time = datetime.fromisoformat(last_file_time)
-                            diff = (now - last_time).total_seconds()
-                            if diff <= 3600:  # 1 hour
-                                active_1h += 1
-                            if diff <= 86400:  # 24 hours
-                                active_24h += 1
-                            if diff <= 604800:  # 7 days
-                                active_7d += 1
-                            else:
-                                inactive_7d += 1
-                        except Exception:
-                            pass
-
-        # Count users from user_preferences.json
-        if os.path.exists('user_preferences.json'):
-            with open('user_preferences.json', 'r') as f:
-                data = json.load(f)
-                all_users.update(int(uid) for uid in data.keys())
-                for uid_str, pref_data in data.items():
-                    if pref_data.get('custom_text'):
-                        custom_captions += 1
-
-        # Load from quota database
-        try:
-            import aiosqlite
-            db_path = os.getenv("QUOTA_DB_PATH", "quota.db")
-            if os.path.exists(db_path):
-                async with aiosqlite.connect(db_path) as db:
-                    cur = await db.execute("SELECT DISTINCT user_id FROM quotas")
-                    rows = await cur.fetchall()
-                    await cur.close()
-                    all_users.update(row[0] for row in rows)
-        except Exception as e:
-            logging.warning(f"Could not load users from quota DB: {e}")
-
-        total_users = len(all_users)
+        # All counts are indexed queries on the user registry
+        total_users = await user_store.count_users()
+        active_1h = await user_store.count_active_since(3600)  # 1 hour
+        active_24h = await user_store.count_active_since(86400)  # 24 hours
+        active_7d = await user_store.count_active_since(604800)  # 7 days
+        custom_captions = await user_store.count_custom_text()
+        inactive_7d = max(total_users - active_7d, 0)
 
     except Exception as e:
         logging.error(f"Error calculating user stats: {e}")
@@ -1390,6 +1304,8 @@ async def status_handler(event):
     # Force join channels
     force_channels = get_forced_channels()
     force_status = f"ON ({len(force_channels)})" if force_channels else "OFF"
+    fj_cache = membership_cache.stats()
+    fj_live = live_membership.stats()
 
     text = (
         "⌬ BOT STATISTICS :\n\n"
@@ -1404,6 +1320,11 @@ async def status_handler(event):
         f"┎ RENAME STATISTICS :\n"
         f"┃ Files renamed : {total_renamed}\n"
         f"┖ Storage used : {format_bytes(total_storage_used)}\n\n"
+        f"┎ THROUGHPUT :\n"
+        f"┃ Last hour : {trends['files_last_hour']} files\n"
+        f"┃ Avg (24h) : {trends['files_per_hour_24h']:.1f} files/hour\n"
+        f"┃ Today : {format_bytes(trends['bytes_today'])}\n"
+        f"┖ Avg (7d) : {format_bytes(trends['bytes_per_day_7d'])}/day\n\n"
         f"👤 Your status\n"
         f"• Captions: {custom_captions}\n"
         f"• Active: none\n\n"
@@ -1417,6 +1338,8 @@ async def status_handler(event):
         f"• Files: {total_renamed}\n"
         f"• Storage: {format_bytes(total_storage_used)}\n"
         f"• Force: {force_status}\n"
+        f"• Join cache: {fj_cache['hits']} hits / {fj_cache['misses']} misses ({fj_cache['hit_rate'] * 100:.0f}%)\n"
+        f"• Live join tracking: {fj_live['watched']} channel(s), {fj_live['events']} updates\n"
         f"• Uptime: {uptime_str()}\n"
     )
     await event.reply(text, parse_mode='html')
@@ -1435,7 +1358,7 @@ async def usage_handler(event):
         await send_force_join_message(event, missing)
         return
     
-    usage_info = get_user_usage_info(user_id)
+    usage_info = await get_user_usage_info(user_id)
     
     # Create a progress bar
     progress_bar_length = 20
@@ -1523,6 +1446,7 @@ async def message_handler(event):
         return
     
     user_id = event.sender_id
+    await touch_user(user_id)
     message_text = event.raw_text.strip()
     
     # Check if user is in a session awaiting custom text
@@ -1541,7 +1465,7 @@ async def message_handler(event):
         if user_id not in sessions:
             sessions[user_id] = {}
         sessions[user_id]['custom_text'] = custom_text
-        save_user_preferences()
+        await save_user_preferences(user_id)
         
         # Confirm and show settings menu
         await event.reply(f"✅ Custom text set to: <code>{custom_text}</code>", parse_mode='html')
@@ -1606,9 +1530,13 @@ async def setthumb_handler(event):
     if has_existing:
         message += "⚠️ <b>Note:</b> You already have a thumbnail. The new one will replace it.\n\n"
     
-    message += """Requirements:
+    if can_normalize_thumbnails():
+        size_rule = "Resized automatically to 320px (max 10 MB)"
+    else:
+        size_rule = "Size limit: 200 KB"
+    message += f"""Requirements:
 - Must be a photo (not document)
-- Size limit: 200 KB
+- {size_rule}
 - Format: JPEG/PNG
 
 💡 <b>Tips for video thumbnails:</b>
@@ -1639,6 +1567,7 @@ async def delthumb_handler(event):
     if os.path.exists(thumb_path):
         try:
             os.remove(thumb_path)
+            thumb_cache.invalidate(user_id)
             await event.reply("✅ <b>Thumbnail deleted successfully!</b>", parse_mode='html')
         except Exception as e:
             await event.reply("❌ <b>Error deleting thumbnail:</b> {}".format(str(e)), parse_mode='html')
@@ -1680,10 +1609,9 @@ async def photo_handler(event):
         return
         
     # Vérifier le quota
-    ok, remaining, reset_time, just_hit_limit = await increment_if_under_limit(
+    ok, remaining, reset_time, just_hit_limit = await quota_store.increment(
         user_id=user_id,
         daily_limit=DAILY_LIMIT,
-        tz_name=QUOTA_TZ,
         is_admin=is_admin(user_id)
     )
     if not ok:
@@ -1707,13 +1635,14 @@ async def photo_handler(event):
     
     # Check if user is in set_thumbnail mode
     if user_id in user_sessions and user_sessions[user_id].get('action') == 'set_thumbnail':
-        # Check size
-        if event.file.size > MAX_THUMB_SIZE:
+        # Check size (with Pillow the photo is shrunk below MAX_THUMB_SIZE anyway)
+        max_input = MAX_THUMB_INPUT_SIZE if can_normalize_thumbnails() else MAX_THUMB_SIZE
+        if event.file.size > max_input:
             await event.reply(
                 "❌ <b>Photo too large!</b>\n\n"
                 "Maximum size: {}\n"
                 "Your photo: {}".format(
-                    human_readable_size(MAX_THUMB_SIZE),
+                    human_readable_size(max_input),
                     human_readable_size(event.file.size)
                 ),
                 parse_mode='html'
@@ -1728,8 +1657,17 @@ async def photo_handler(event):
             # Progress message
             progress_msg = await event.reply("⏳ <b>Saving thumbnail...</b>", parse_mode='html')
             
-            # Download the photo
-            await event.download_media(file=thumb_path)
+            # Download the photo, then normalize it once off the event loop:
+            # 320px max, compact JPEG, no metadata (kept as-is without Pillow)
+            raw_path = f"{thumb_path}.upload"
+            raw_path = await event.download_media(file=raw_path) or raw_path
+            try:
+                if not await asyncio.to_thread(normalize_thumbnail, raw_path, thumb_path):
+                    os.replace(raw_path, thumb_path)
+            finally:
+                if os.path.exists(raw_path):
+                    os.remove(raw_path)
+            thumb_cache.invalidate(user_id)
             
             # Confirm
             await safe_edit(progress_msg,
@@ -1756,43 +1694,34 @@ async def file_handler(event):
     if not event.is_private:
         return
     
-    # Vérifier le quota
-    ok, remaining, reset_time, just_hit_limit = await increment_if_under_limit(
+    file = event.file
+    file_size_bytes = int(file.size) if getattr(file, 'size', None) else 0
+    
+    # Réserver l'action une seule fois pour tout le cycle de vie du fichier ;
+    # les octets ne sont débités que si un traitement avec miniature est lancé
+    reservation = await quota_store.reserve(
         user_id=user_id,
         daily_limit=DAILY_LIMIT,
-        tz_name=QUOTA_TZ,
         is_admin=is_admin(user_id)
     )
-    if not ok:
+    if not reservation.ok:
         await event.reply(
             f"🚫 You've used all your daily quota for today. "
-            f"Please try again after {reset_time}.",
+            f"Please try again after {reservation.reset_time}.",
             parse_mode='html'
         )
         return
 
-    # Notification si quota vient d'être atteint
-    if just_hit_limit:
-        await bot.send_message(
-            user_id,
-            f"⚠️ <b>Quota Alert!</b>\n\n"
-            f"You've reached your daily quota limit of {DAILY_LIMIT} actions.\n"
-            f"Your quota will reset at {reset_time}.\n\n"
-            f"<i>Thank you for using the bot!</i>",
-            parse_mode='html'
-        )
-    
     # Force-join
     ok, missing = await is_user_in_required_channels(user_id)
     if not ok:
+        await quota_store.refund(reservation.token)
         await send_force_join_message(event, missing)
         return
     
-    file = event.file
-    file_size_bytes = int(file.size) if getattr(file, 'size', None) else 0
-    
     # Size check
     if file_size_bytes and file_size_bytes > MAX_FILE_SIZE:
+        await quota_store.refund(reservation.token)
         await event.reply(
             "❌ <b>File too large!</b>\n\n"
             f"Maximum: {human_readable_size(MAX_FILE_SIZE)}\n"
@@ -1801,7 +1730,16 @@ async def file_handler(event):
         )
         return
     
-    # Quota check is now done at the beginning of the function
+    # Notification si quota vient d'être atteint (le fichier est bien compté)
+    if reservation.just_reached_limit:
+        await bot.send_message(
+            user_id,
+            f"⚠️ <b>Quota Alert!</b>\n\n"
+            f"You've reached your daily quota limit of {DAILY_LIMIT} actions.\n"
+            f"Your quota will reset at {reservation.reset_time}.\n\n"
+            f"<i>Thank you for using the bot!</i>",
+            parse_mode='html'
+        )
     
     file_name = file.name or "unnamed_file"
     extension = os.path.splitext(file_name)[1] or ""
@@ -1824,6 +1762,7 @@ async def file_handler(event):
         'file_size': file_size_bytes,
         'is_video': is_video,
         'mime_type': mime_type,
+        'quota_token': reservation.token,
         'timestamp': datetime.now(),
     }
     # Fire-and-forget periodic cleanup
@@ -1851,14 +1790,15 @@ async def callback_handler(event):
     """Stateless handler for inline buttons and settings"""
     data = event.data.decode('utf-8')
     user_id = event.query.user_id
+    await touch_user(user_id)
     
     # Ignorer la vérification des quotas pour certaines commandes
-    if not data.startswith(('cancel|', 'no_thumb', 'show_settings', 'back_to_main', 'toggle_', 'close_')):
+    # Les actions sur un fichier (ren|, thumb|) sont couvertes par la réservation faite à la réception
+    if not data.startswith(('cancel|', 'ren|', 'thumb|', 'no_thumb', 'show_settings', 'back_to_main', 'toggle_', 'close_')):
         # Vérifier le quota pour les actions qui en consomment
-        ok, remaining, reset_time, just_hit_limit = await increment_if_under_limit(
+        ok, remaining, reset_time, just_hit_limit = await quota_store.increment(
             user_id=user_id,
             daily_limit=DAILY_LIMIT,
-            tz_name=QUOTA_TZ,
             is_admin=is_admin(user_id)
         )
         if not ok:
@@ -1910,7 +1850,7 @@ async def callback_handler(event):
         current = sessions[user_id].get('text_position', 'end')
         new_pos = 'start' if current == 'end' else 'end'
         sessions[user_id]['text_position'] = new_pos
-        save_user_preferences()
+        await save_user_preferences(user_id)
         await event.answer(f"Position changed to {new_pos}.", alert=True)
         await show_settings_menu(event)
         return
@@ -1918,7 +1858,7 @@ async def callback_handler(event):
         if user_id not in sessions:
             sessions[user_id] = {}
         sessions[user_id]['custom_text'] = ''
-        save_user_preferences()
+        await save_user_preferences(user_id)
         await event.answer("Custom text removed.", alert=True)
         await show_settings_menu(event)
         return
@@ -1927,7 +1867,7 @@ async def callback_handler(event):
             sessions[user_id] = {}
         current = sessions[user_id].get('clean_tags', True)
         sessions[user_id]['clean_tags'] = not current
-        save_user_preferences()
+        await save_user_preferences(user_id)
         await event.answer(f"Clean tags: {'On' if sessions[user_id]['clean_tags'] else 'Off'}", alert=True)
         await show_settings_menu(event)
         return
@@ -1965,6 +1905,8 @@ async def callback_handler(event):
         
         async with PROCESSING_LOCKS.setdefault(lock_key, asyncio.Lock()):
             if action == "cancel":
+                await quota_store.refund(stored_data.get('quota_token'))
+                ORIGINAL_MESSAGES.pop(storage_key, None)
                 await event.edit("❌ <b>Cancelled.</b>", parse_mode='html')
                 return
             elif action in ("ren", "thumb"):
@@ -2040,33 +1982,8 @@ async def rename_reply_handler(event):
     # Ignore channels and groups
     if not event.is_private:
         return
-        
-    # Vérifier le quota
-    ok, remaining, reset_time, just_hit_limit = await increment_if_under_limit(
-        user_id=user_id,
-        daily_limit=DAILY_LIMIT,
-        tz_name=QUOTA_TZ,
-        is_admin=is_admin(user_id)
-    )
-    if not ok:
-        await event.reply(
-            f"🚫 You've used all your daily quota for today. "
-            f"Please try again after {reset_time}.",
-            parse_mode='html'
-        )
-        return
-
-    # Notification si quota vient d'être atteint
-    if just_hit_limit:
-        await bot.send_message(
-            user_id,
-            f"⚠️ <b>Quota Alert!</b>\n\n"
-            f"You've reached your daily quota limit of {DAILY_LIMIT} actions.\n"
-            f"Your quota will reset at {reset_time}.\n\n"
-            f"<i>Thank you for using the bot!</i>",
-            parse_mode='html'
-        )
     
+    # Quota already reserved by file_handler; only commit/refund below
     if user_id not in user_sessions:
         return
     sess = user_sessions[user_id]
@@ -2117,6 +2034,8 @@ async def rename_reply_handler(event):
                 supports_streaming=True,
                 force_document=not getattr(original_msg, 'video', False)
             )
+            # Rename-only re-sends the media by reference: no bytes consumed
+            await quota_store.commit((sess.get('stored_data') or {}).get('quota_token'), nbytes=0)
             await event.reply("✅ File renamed successfully!")
             # Update rename stats (best-effort)
             try:
@@ -2125,6 +2044,42 @@ async def rename_reply_handler(event):
                 pass
             
         elif action == 'thumb_stateless':
+            # Thumbnail jobs download and re-upload the file: charge its bytes now
+            stored = sess.get('stored_data') or {}
+            file_size_bytes = int(stored.get('file_size') or 0)
+            charged = await quota_store.charge_bytes(
+                stored.get('quota_token'), file_size_bytes, byte_limit=DAILY_LIMIT_BYTES
+            )
+            if charged is None:
+                # The file's reservation was already settled: reserve again for this job
+                reservation = await quota_store.reserve(
+                    user_id=user_id,
+                    daily_limit=DAILY_LIMIT,
+                    is_admin=is_admin(user_id)
+                )
+                if not reservation.ok:
+                    await event.reply(
+                        f"🚫 You've used all your daily quota for today. "
+                        f"Please try again after {reservation.reset_time}.",
+                        parse_mode='html'
+                    )
+                    ORIGINAL_MESSAGES.pop(sess.get('storage_key'), None)
+                    return
+                stored['quota_token'] = reservation.token
+                charged = await quota_store.charge_bytes(
+                    reservation.token, file_size_bytes, byte_limit=DAILY_LIMIT_BYTES
+                )
+            if not charged:
+                await quota_store.refund(stored.get('quota_token'))
+                usage_info = await get_user_usage_info(user_id)
+                await event.reply(
+                    f"🚫 Daily limit reached! Used: {human_readable_size(usage_info['daily_used'])}"
+                    f"/{human_readable_size(DAILY_LIMIT_BYTES)}. "
+                    f"Remaining: {human_readable_size(usage_info['daily_remaining'])}",
+                    parse_mode='html'
+                )
+                ORIGINAL_MESSAGES.pop(sess.get('storage_key'), None)
+                return
             # Build a minimal, self-contained session snapshot for queued processing
             sess_copy = {
                 'action': 'thumb_stateless',
@@ -2133,6 +2088,9 @@ async def rename_reply_handler(event):
                 'storage_key': sess.get('storage_key'),
                 'timestamp': datetime.now(),
             }
+            # From here on the job owns the quota token; cache cleanup must leave it alone
+            if sess.get('stored_data') is not None:
+                sess['stored_data']['in_flight'] = True
             # Always enqueue; the worker will process immediately if this is the only job
             q = THUMB_QUEUES.setdefault(user_id, asyncio.Queue())
             worker_active = user_id in THUMB_WORKERS and THUMB_WORKERS[user_id] and not THUMB_WORKERS[user_id].done()
@@ -2159,6 +2117,8 @@ async def rename_reply_handler(event):
                 del user_sessions[user_id]
             return
     except Exception as e:
+        if action == 'rename_stateless':
+            await quota_store.refund((sess.get('stored_data') or {}).get('quota_token'))
         await event.reply(f"❌ Error: {str(e)}")
     finally:
         # Clean up prompt message, cache entry, and clear short-lived session
@@ -2216,33 +2176,9 @@ async def process_with_thumbnail(event, user_id, new_name, sess=None):
     temp_path = None
     stored_data = None
     storage_key = None
+    # Quota was reserved once by file_handler; commit or refund its token here
+    quota_token = ((sess or {}).get('stored_data') or {}).get('quota_token')
     
-    # Vérifier le quota
-    ok, remaining, reset_time, just_hit_limit = await increment_if_under_limit(
-        user_id=user_id,
-        daily_limit=DAILY_LIMIT,
-        tz_name=QUOTA_TZ,
-        is_admin=is_admin(user_id)
-    )
-    if not ok:
-        await event.reply(
-            f"🚫 You've used all your daily quota for today. "
-            f"Please try again after {reset_time}.",
-            parse_mode='html'
-        )
-        return
-
-    # Notification si quota vient d'être atteint
-    if just_hit_limit:
-        await bot.send_message(
-            user_id,
-            f"⚠️ <b>Quota Alert!</b>\n\n"
-            f"You've reached your daily quota limit of {DAILY_LIMIT} actions.\n"
-            f"Your quota will reset at {reset_time}.\n\n"
-            f"<i>Thank you for using the bot!</i>",
-            parse_mode='html'
-        )
-        
     try:
         # Prepare name
         sanitized_name = sanitize_filename(new_name)
@@ -2286,42 +2222,35 @@ async def process_with_thumbnail(event, user_id, new_name, sess=None):
             is_video = user_sessions[user_id].get('is_video', False)
             file_size = user_sessions[user_id]['file_size']
         
-        # Download the file
-        temp_filename = f"{user_id}_{int(time.time())}_{uuid.uuid4().hex[:8]}"
-        temp_path = os.path.join(TEMP_DIR, temp_filename)
-        
-        start_time = time.time()
-        last_update_time = [start_time]
-        
-        async def download_progress(current, total):
-            await progress_callback(current, total, event, start_time, progress_msg, "Downloading", last_update_time)
-        
-        path = await original_msg.download_media(
-            file=temp_path,
-            progress_callback=download_progress
-        )
-        
-        if not path or not os.path.exists(path):
-            raise Exception("Failed to download file")
-        
-        if path != temp_path:
-            shutil.move(path, temp_path)
-        
         # Get the thumbnail
         thumb_path = os.path.join(THUMBNAIL_DIR, f"{user_id}.jpg")
         
-        # Check/convert for compatibility if it's a video
-        if is_video:
-            temp_path = await ensure_video_compatibility(temp_path, progress_msg)
-            # Create optimized attributes
-            file_attributes = get_video_attributes(temp_path, sanitized_name)
-        else:
-            file_attributes = [DocumentAttributeFilename(sanitized_name)]
-        
         # Minimal caption (just the name like rename_only)
         caption = f"<code>{sanitized_name}</code>"
         
-        await safe_edit(progress_msg, "Preparing upload with thumbnail...", parse_mode=None)
+        # Prefer Telegram's own DocumentAttributeVideo for the attributes; it names
+        # no codec, so small videos get their head probed to decide on a conversion
+        document = getattr(original_msg, 'document', None)
+        media_info = info_from_document(document) if is_video else None
+        small = int(file_size or 0) <= COMPAT_CONVERT_MAX_BYTES
+        can_convert = media_jobs.available()
+        if STREAM_PIPE and small and can_convert and media_info is not None and not media_info.has_video:
+            try:
+                _, media_info = await probe_document_head(
+                    event.client, document, int(getattr(document, 'size', 0) or file_size or 0), media_info
+                )
+            except Exception as e:
+                logging.warning(f"Head probe of {sanitized_name} failed: {e}")
+        # Large videos are converted on the fly when ffmpeg can sit in the pipe;
+        # without it, a video lacking attributes must still be probed locally
+        stream_convert = STREAM_PIPE and STREAM_TRANSCODE and can_convert
+        needs_local = is_video and (
+            (media_info is None and (small or not stream_convert))
+            or (
+                media_info is not None and small and can_convert
+                and (not media_info.has_video or media_jobs.plan(media_info) is not None)
+            )
+        )
         
         start_time = time.time()
         last_update_time_upload = [start_time]
@@ -2329,28 +2258,128 @@ async def process_with_thumbnail(event, user_id, new_name, sess=None):
         async def upload_progress(current, total):
             await progress_callback(current, total, event, start_time, progress_msg, "Uploading", last_update_time_upload)
         
-        # Send with thumbnail
-        await safe_send_file(
-            event.client,
-            event.chat_id,
-            temp_path,
+        send_kwargs = {}
+        file_to_send = None
+        if STREAM_PIPE and document is not None and not needs_local:
+            doc_size = int(getattr(document, 'size', 0) or file_size or 0)
+            if stream_convert and is_video and (media_info is None or not media_info.supports_streaming):
+                # Large non-streamable (or attribute-less) video: ffmpeg sits between download and upload, no disk
+                last_update_time_convert = [start_time]
+                
+                async def convert_progress(current, total):
+                    await progress_callback(current, total, event, start_time, progress_msg, "Converting", last_update_time_convert)
+                
+                mp4_name = os.path.splitext(sanitized_name)[0] + '.mp4'
+                try:
+                    result = await stream_transcode_document(
+                        event.client, document, doc_size, mp4_name, media_info, convert_progress
+                    )
+                except Exception as e:
+                    logging.warning(f"Streamed conversion of {sanitized_name} failed, sending original: {e}")
+                    result = (None, media_info)
+                converted, probed_info = result
+                media_info = media_info or probed_info
+                if converted is not None:
+                    file_to_send, media_info = converted, probed_info
+                    sanitized_name = mp4_name
+                    caption = f"<code>{sanitized_name}</code>"
+                    send_kwargs['mime_type'] = 'video/mp4'
+            if file_to_send is None:
+                # No ffmpeg needed: pipe Telegram -> Telegram, download and upload overlap, no temp file
+                if media_info:
+                    logging.info(f"Streaming {sanitized_name}: {media_info.describe()}")
+                file_to_send = await pipe_document(
+                    event.client,
+                    document,
+                    doc_size,
+                    sanitized_name,
+                    progress_callback=upload_progress,
+                )
+                send_kwargs['mime_type'] = getattr(document, 'mime_type', None)
+            await safe_edit(progress_msg, "Finalizing upload with thumbnail...", parse_mode=None)
+        else:
+            # Download the file
+            temp_filename = f"{user_id}_{int(time.time())}_{uuid.uuid4().hex[:8]}"
+            temp_path = os.path.join(TEMP_DIR, temp_filename)
+            
+            last_update_time = [start_time]
+            
+            async def download_progress(current, total):
+                await progress_callback(current, total, event, start_time, progress_msg, "Downloading", last_update_time)
+            
+            download_size = int(getattr(document, 'size', 0) or file_size or 0)
+            if document is not None and download_size >= PARALLEL_MIN_SIZE:
+                # Large file: ranges fetched concurrently into a preallocated file
+                path = await download_parallel(
+                    event.client,
+                    document,
+                    temp_path,
+                    download_size,
+                    progress_callback=download_progress,
+                )
+            else:
+                path = await original_msg.download_media(
+                    file=temp_path,
+                    progress_callback=download_progress
+                )
+            
+            if not path or not os.path.exists(path):
+                raise Exception("Failed to download file")
+            
+            if path != temp_path:
+                shutil.move(path, temp_path)
+            
+            # Check/convert for compatibility if it's a video
+            if is_video:
+                if media_info is None or not media_info.has_video:
+                    media_info = await probe_media(temp_path) or media_info
+                if media_info:
+                    logging.info(f"Probed {sanitized_name}: {media_info.describe()}")
+                temp_path, media_info = await ensure_video_compatibility(temp_path, progress_msg, media_info)
+            
+            await safe_edit(progress_msg, "Preparing upload with thumbnail...", parse_mode=None)
+            start_time = time.time()
+            # Parts uploaded concurrently (UPLOAD_WINDOW in flight, per-part retry)
+            file_to_send = await upload_file_parallel(
+                event.client,
+                temp_path,
+                os.path.basename(sanitized_name),
+                progress_callback=upload_progress,
+            )
+        
+        if is_video:
+            # Create optimized attributes
+            file_attributes = get_video_attributes(sanitized_name, media_info)
+        else:
+            file_attributes = [DocumentAttributeFilename(sanitized_name)]
+        
+        # Send with thumbnail (uploaded once per user and reused across jobs)
+        send_kwargs.update(
             caption=caption,
             parse_mode='html',
             file_name=sanitized_name,
-            thumb=thumb_path,
             supports_streaming=True,
             # IMPORTANT: send as video (not document) to keep inline player
             force_document=not is_video,
             attributes=file_attributes,
             progress_callback=upload_progress,
             allow_cache=False,
-            part_size_kb=1024  # Augmente la taille des chunks d'upload à 1 MB
         )
+        thumb = await thumb_cache.get(event.client, user_id, thumb_path)
+        try:
+            await safe_send_file(event.client, event.chat_id, file_to_send, thumb=thumb, **send_kwargs)
+        except Exception as e:
+            if thumb is None or not is_expired_upload_error(e):
+                raise
+            # Telegram dropped the cached thumbnail upload: upload it again, once
+            thumb_cache.invalidate(user_id)
+            thumb = await thumb_cache.get(event.client, user_id, thumb_path)
+            await safe_send_file(event.client, event.chat_id, file_to_send, thumb=thumb, **send_kwargs)
         
-        await progress_msg.delete()
+        # Delivered: update usage (the reserved bytes are kept) before any cosmetic cleanup
+        await quota_store.commit(quota_token)
         
-        # Update usage
-        update_user_usage(user_id, file_size)
+        await progress_msg.delete()
         try:
             await add_rename_stat(int(file_size or 0))
         except Exception:
@@ -2379,6 +2408,7 @@ async def process_with_thumbnail(event, user_id, new_name, sess=None):
             del user_sessions[user_id]
         
     except Exception as e:
+        await quota_store.refund(quota_token)
         error_msg = f"❌ Error: {str(e)}"
         if progress_msg:
             await safe_edit(progress_msg, error_msg, parse_mode='html')
@@ -2406,15 +2436,76 @@ async def process_with_thumbnail(event, user_id, new_name, sess=None):
                     pass
             del user_sessions[user_id]
 
+async def _timed_load(name, coro):
+    """Await one startup source and log how long it took"""
+    start = perf_counter()
+    try:
+        await coro
+    except Exception as e:
+        logging.error(f"[startup] {name} failed after {(perf_counter() - start) * 1000:.0f} ms: {e}")
+        raise
+    logging.info(f"[startup] {name} loaded in {(perf_counter() - start) * 1000:.0f} ms")
+
+async def _warm_quota():
+    await quota_store.open()
+    await quota_store.warm()
+
+async def on_startup():
+    """Load all persisted state concurrently before the bot receives any update"""
+    start = perf_counter()
+    sources = {
+        "quota/usage": _warm_quota(),
+        "preferences": user_store.open(),
+        "forced channels": asyncio.to_thread(fj_registry.reload),
+        "rename stats": asyncio.to_thread(rename_stats.load),
+    }
+    # One broken source must not keep the bot down: it starts empty and
+    # the stores load lazily on first use
+    results = await asyncio.gather(
+        *(_timed_load(name, coro) for name, coro in sources.items()),
+        return_exceptions=True,
+    )
+    failed = {name for name, result in zip(sources, results) if isinstance(result, BaseException)}
+    for name in failed:
+        logging.warning(f"[startup] {name} unavailable, starting with empty defaults")
+    if not can_normalize_thumbnails():
+        logging.warning("[startup] Pillow not installed: thumbnails are sent without normalization")
+    if user_store.needs_backfill and not failed & {"quota/usage", "preferences"}:
+        # First start with the activity columns: register users only known to the quota DB
+        await _timed_load("user registry backfill", user_store.register_many(await quota_store.user_ids()))
+    asyncio.create_task(rename_stats.run())
+    logging.info(f"[startup] state warm-up done in {(perf_counter() - start) * 1000:.0f} ms")
+
+async def on_shutdown():
+    """Release long-lived resources"""
+    await media_jobs.kill_all()
+    rename_stats.flush()
+    await state_writer.flush()
+    await quota_store.close()
+    await user_store.close()
+
 # Ajoutez ce code à la fin du fichier, après toutes les fonctions
 if __name__ == '__main__':
     print("🔄 Starting bot...")
     try:
+        # Charger l'état avant de connecter le client : aucun handler ne
+        # peut recevoir d'update avant la fin du warm-up
+        bot.loop.run_until_complete(on_startup())
         # Démarrer le client
-        with bot:
-            print("✅ Bot is running! Press Ctrl+C to stop.")
-            bot.run_until_disconnected()
+        bot.start(bot_token=TOKEN)
+        # Needs a connected client: find the forced channels where we get participant updates
+        bot.loop.run_until_complete(refresh_live_membership())
+        print("✅ Bot is running! Press Ctrl+C to stop.")
+        bot.run_until_disconnected()
     except Exception as e:
         print(f"❌ Error: {str(e)}")
     finally:
+        try:
+            bot.loop.run_until_complete(on_shutdown())
+        except Exception:
+            pass
+        try:
+            bot.disconnect()
+        except Exception:
+            pass
         print("🛑 Bot stopped")
\ No newline at end of file
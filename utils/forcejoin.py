@@ -0,0 +1,318 @@
+# utils/forcejoin.py
+from __future__ import annotations
+
+import os
+import json
+import time
+import logging
+
+# Durées de vie du cache d'appartenance (secondes) : un membre reste membre
+# longtemps, un non-membre doit pouvoir rejoindre et réessayer vite.
+POSITIVE_TTL = float(os.getenv("FJ_POSITIVE_TTL", "600"))
+NEGATIVE_TTL = float(os.getenv("FJ_NEGATIVE_TTL", "30"))
+MAX_ENTRIES = int(os.getenv("FJ_CACHE_MAX_ENTRIES", "50000"))
+# Un état tenu par les updates peut rater un départ (déconnexion, redémarrage
+# sans catch_up) : un membre observé est revérifié au plus tard après ce délai.
+LIVE_TTL = float(os.getenv("FJ_LIVE_TTL", "86400"))
+# Vérifications GetParticipant lancées en parallèle (tous utilisateurs
+# confondus) et délai maximal de chacune
+CHECK_CONCURRENCY = int(os.getenv("FJ_CHECK_CONCURRENCY", "8"))
+CHECK_TIMEOUT = float(os.getenv("FJ_CHECK_TIMEOUT", "5"))
+
+def clean_channel(ch) -> str:
+    """'@name', '#name', ' name ' -> 'name'."""
+    return str(ch).strip().lstrip("@").lstrip("#")
+
+
+class ChannelRegistry:
+    """
+    Liste des canaux obligatoires, gardée en mémoire.
+
+    Le fichier JSON est lu une fois, puis relu seulement si son mtime change
+    (édition à la main). Les lectures n'écrivent jamais ; set/add/remove
+    mettent la mémoire à jour et programment l'écriture via le writer partagé.
+
+    "resolved" garde, par canal, l'id et l'access_hash obtenus à la
+    résolution du nom : les vérifications n'ont plus à résoudre le username.
+    """
+
+    def __init__(self, path, writer) -> None:
+        self.path = os.fspath(path)
+        self.writer = writer
+        self._channels: list[str] = []
+        self._resolved: dict[str, dict] = {}
+        self._mtime: float | None = None
+        self._loaded = False
+
+    def _current_mtime(self) -> float | None:
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def reload(self) -> None:
+        """Relit le fichier sans jamais le réécrire."""
+        mtime = self._current_mtime()
+        data = {}
+        try:
+            if mtime is not None:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f) or {}
+            channels = self._dedupe(data.get("channels", []))
+            resolved = {
+                clean_channel(ch): {"id": int(ref["id"]), "access_hash": int(ref["access_hash"])}
+                for ch, ref in (data.get("resolved") or {}).items()
+                if clean_channel(ch) in channels and ref
+            }
+        except Exception as e:
+            logging.error(f"Error loading {os.path.basename(self.path)}: {e}")
+            # Garde la liste actuelle, sans relire à chaque appel
+            self._mtime = mtime
+            self._loaded = True
+            return
+        self._channels = channels
+        self._resolved = resolved
+        self._mtime = mtime
+        self._loaded = True
+
+    @staticmethod
+    def _dedupe(channels) -> list[str]:
+        out = []
+        for ch in channels:
+            c = clean_channel(ch)
+            if c and c not in out:
+                out.append(c)
+        return out
+
+    def channels(self) -> list[str]:
+        """Canaux configurés (copie) ; relit le fichier seulement si son mtime a changé."""
+        if not self._loaded:
+            self.reload()
+        elif self._current_mtime() != self._mtime and not self.writer.pending(self.path):
+            # Une écriture à nous en attente ou en cours n'est pas une édition à la main
+            self.reload()
+        return list(self._channels)
+
+    def _schedule_write(self) -> None:
+        self.writer.schedule(
+            self.path,
+            {"channels": self._channels, "resolved": self._resolved},
+            on_written=self._written,
+        )
+
+    def _written(self) -> None:
+        # Le fichier vient d'être écrit depuis la mémoire : son mtime n'est pas un changement
+        self._mtime = self._current_mtime()
+
+    def set(self, channels) -> list[str]:
+        self._channels = self._dedupe(channels)
+        self._resolved = {ch: ref for ch, ref in self._resolved.items() if ch in self._channels}
+        self._schedule_write()
+        return list(self._channels)
+
+    def add(self, channels) -> list[str]:
+        return self.set(self.channels() + list(channels))
+
+    def remove(self, channels) -> list[str]:
+        drop = {clean_channel(ch) for ch in channels}
+        return self.set([c for c in self.channels() if c not in drop])
+
+    def resolved(self, channel) -> tuple[int, int] | None:
+        """(channel_id, access_hash) mémorisés pour ce canal, sinon None."""
+        self.channels()
+        ref = self._resolved.get(clean_channel(channel))
+        return (ref["id"], ref["access_hash"]) if ref else None
+
+    def set_resolved(self, channel, channel_id: int, access_hash: int) -> None:
+        ch = clean_channel(channel)
+        ref = {"id": int(channel_id), "access_hash": int(access_hash)}
+        if ch not in self._channels or self._resolved.get(ch) == ref:
+            return
+        self._resolved[ch] = ref
+        self._schedule_write()
+
+    def drop_resolved(self, channel) -> None:
+        if self._resolved.pop(clean_channel(channel), None) is not None:
+            self._schedule_write()
+
+
+def _prune_entries(entries: dict, max_entries: int, now: float) -> None:
+    """Retire les entrées (membre, expiration) expirées, puis les plus anciennes insertions."""
+    for key in [k for k, (_, exp) in entries.items() if exp <= now]:
+        del entries[key]
+    while len(entries) > max_entries:
+        del entries[next(iter(entries))]
+
+
+class MembershipCache:
+    """
+    Cache des vérifications d'appartenance, clé (user_id, canal).
+
+    Les résultats positifs et négatifs ont chacun leur TTL. get() renvoie
+    None si l'entrée manque ou a expiré ; hits/misses comptent les lectures.
+    """
+
+    def __init__(
+        self,
+        positive_ttl: float = POSITIVE_TTL,
+        negative_ttl: float = NEGATIVE_TTL,
+        max_entries: int = MAX_ENTRIES,
+    ) -> None:
+        self.positive_ttl = max(0.0, float(positive_ttl))
+        self.negative_ttl = max(0.0, float(negative_ttl))
+        self.max_entries = max(1, int(max_entries))
+        self.hits = 0
+        self.misses = 0
+        self._entries: dict[tuple[int, str], tuple[bool, float]] = {}
+
+    def get(self, user_id: int, channel, now: float | None = None) -> bool | None:
+        now = time.monotonic() if now is None else now
+        key = (int(user_id), clean_channel(channel))
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= now:
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def set(self, user_id: int, channel, member: bool, now: float | None = None) -> None:
+        now = time.monotonic() if now is None else now
+        ttl = self.positive_ttl if member else self.negative_ttl
+        if ttl <= 0:
+            return
+        key = (int(user_id), clean_channel(channel))
+        self._entries.pop(key, None)
+        self._entries[key] = (bool(member), now + ttl)
+        if len(self._entries) > self.max_entries:
+            self._prune(now)
+
+    def _prune(self, now: float) -> None:
+        _prune_entries(self._entries, self.max_entries, now)
+
+    def invalidate(self, user_id: int | None = None, channel=None) -> None:
+        """Oublie un utilisateur, un canal, les deux, ou tout si aucun argument."""
+        if user_id is None and channel is None:
+            self._entries.clear()
+            return
+        ch = clean_channel(channel) if channel is not None else None
+        for key in list(self._entries):
+            if (user_id is None or key[0] == user_id) and (ch is None or key[1] == ch):
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+            "entries": len(self._entries),
+        }
+
+
+def participant_is_member(participant) -> bool:
+    """
+    Traduit le new_participant d'un UpdateChannelParticipant.
+
+    None ou ChannelParticipantLeft : parti ; ChannelParticipantBanned avec
+    left=True : exclu ; tout le reste compte comme membre.
+    """
+    if participant is None:
+        return False
+    if type(participant).__name__ == "ChannelParticipantLeft":
+        return False
+    return not getattr(participant, "left", False)
+
+
+class LiveMembership:
+    """
+    Appartenance tenue à jour par les updates de participants.
+
+    Seuls les canaux où le bot est admin sont surveillés (watch) : Telegram
+    y pousse chaque arrivée et départ. Une update peut pourtant manquer
+    (déconnexion, redémarrage sans catch_up) : un membre observé expire donc
+    après `live_ttl`, un non-membre après `negative_ttl`, et le nombre
+    d'entrées est plafonné comme dans MembershipCache. get() renvoie None
+    pour un canal non surveillé ou un utilisateur inconnu ou expiré ;
+    l'appelant vérifie alors par RPC puis appelle record(). apply() reçoit
+    les updates ; consume() les lit depuis n'importe quelle source
+    asynchrone de (channel_id, user_id, membre).
+    """
+
+    def __init__(
+        self,
+        live_ttl: float = LIVE_TTL,
+        negative_ttl: float = NEGATIVE_TTL,
+        max_entries: int = MAX_ENTRIES,
+    ) -> None:
+        self.live_ttl = max(0.0, float(live_ttl))
+        self.negative_ttl = max(0.0, float(negative_ttl))
+        self.max_entries = max(1, int(max_entries))
+        self._ids: dict[int, str] = {}            # channel_id -> nom du canal
+        self._names: set[str] = set()
+        # (user_id, nom du canal) -> (membre, expiration monotonic)
+        self._entries: dict[tuple[int, str], tuple[bool, float]] = {}
+        self.events = 0
+
+    def set_watched(self, channels: dict[str, int]) -> None:
+        """Remplace l'ensemble surveillé ({nom: channel_id}) ; garde l'état des canaux conservés."""
+        names = {clean_channel(ch): int(cid) for ch, cid in channels.items()}
+        self._ids = {cid: name for name, cid in names.items()}
+        self._names = set(names)
+        for key in [k for k in self._entries if k[1] not in self._names]:
+            del self._entries[key]
+
+    def watched(self) -> list[str]:
+        return list(self._names)
+
+    def is_watched(self, channel) -> bool:
+        return clean_channel(channel) in self._names
+
+    def get(self, user_id: int, channel, now: float | None = None) -> bool | None:
+        key = (int(user_id), clean_channel(channel))
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        now = time.monotonic() if now is None else now
+        if entry[1] <= now:
+            del self._entries[key]
+            return None
+        return entry[0]
+
+    def _set(self, user_id: int, name: str, member: bool, now: float | None) -> None:
+        now = time.monotonic() if now is None else now
+        ttl = self.live_ttl if member else self.negative_ttl
+        key = (int(user_id), name)
+        self._entries.pop(key, None)
+        if ttl <= 0:
+            return
+        self._entries[key] = (bool(member), now + ttl)
+        if len(self._entries) > self.max_entries:
+            _prune_entries(self._entries, self.max_entries, now)
+
+    def record(self, user_id: int, channel, member: bool, now: float | None = None) -> None:
+        """Enregistre un résultat RPC pour un canal surveillé."""
+        name = clean_channel(channel)
+        if name in self._names:
+            self._set(user_id, name, member, now)
+
+    def apply(self, channel_id: int, user_id: int, member: bool) -> str | None:
+        """Applique une arrivée/un départ ; renvoie le nom du canal s'il est surveillé."""
+        name = self._ids.get(int(channel_id))
+        if name is None:
+            return None
+        self._set(user_id, name, member, None)
+        self.events += 1
+        return name
+
+    async def consume(self, source) -> None:
+        async for channel_id, user_id, member in source:
+            self.apply(channel_id, user_id, member)
+
+    def stats(self) -> dict:
+        return {
+            "watched": len(self._names),
+            "known": len(self._entries),
+            "events": self.events,
+        }
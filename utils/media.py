@@ -0,0 +1,473 @@
+# utils/media.py
+from __future__ import annotations
+
+import io
+import os
+import json
+import shutil
+import asyncio
+import logging
+
+PROBE_TIMEOUT = float(os.getenv("FFPROBE_TIMEOUT", "30"))
+_CPUS = os.cpu_count() or 1
+# Jobs ffmpeg qui encodent en même temps, threads accordés à chacun, durée max
+FFMPEG_SLOTS = int(os.getenv("FFMPEG_SLOTS", str(max(1, _CPUS // 2))))
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", str(max(1, _CPUS // max(1, FFMPEG_SLOTS)))))
+FFMPEG_TIMEOUT = float(os.getenv("FFMPEG_TIMEOUT", "1800"))
+# Conversion à la volée : fichier de plusieurs Go, au rythme du téléchargement.
+# Elle a ses propres slots (elle en garde un pendant des heures) et n'attend
+# un slot libre que FFMPEG_STREAM_SLOT_WAIT secondes.
+FFMPEG_STREAM_TIMEOUT = float(os.getenv("FFMPEG_STREAM_TIMEOUT", "14400"))
+FFMPEG_STREAM_SLOTS = int(os.getenv("FFMPEG_STREAM_SLOTS", "1"))
+FFMPEG_STREAM_SLOT_WAIT = float(os.getenv("FFMPEG_STREAM_SLOT_WAIT", "300"))
+
+# Miniatures : côté max et poids visés par Telegram
+THUMB_MAX_SIDE = 320
+THUMB_MAX_BYTES = 200 * 1024
+
+# Ce que le lecteur intégré de Telegram lit sans conversion
+COMPATIBLE_VIDEO = {"h264"}
+COMPATIBLE_AUDIO = {"aac", "mp3"}
+
+
+class MediaInfo:
+    """
+    Métadonnées d'un fichier, issues d'un seul appel ffprobe (format + streams).
+    - duration en secondes, width/height du premier flux vidéo (0 si inconnus)
+    - video_codec/audio_codec = codec_name ffprobe, None si pas de flux
+    - supports_streaming = drapeau du DocumentAttributeVideo Telegram
+    - source = 'ffprobe' ou 'telegram'
+    """
+
+    __slots__ = (
+        "duration", "width", "height", "video_codec", "audio_codec",
+        "format_name", "bit_rate", "size", "supports_streaming", "source",
+    )
+
+    def __init__(
+        self,
+        duration: float = 0.0,
+        width: int = 0,
+        height: int = 0,
+        video_codec: str | None = None,
+        audio_codec: str | None = None,
+        format_name: str | None = None,
+        bit_rate: int = 0,
+        size: int = 0,
+        supports_streaming: bool = False,
+        source: str = "ffprobe",
+    ) -> None:
+        self.duration = duration
+        self.width = width
+        self.height = height
+        self.video_codec = video_codec
+        self.audio_codec = audio_codec
+        self.format_name = format_name
+        self.bit_rate = bit_rate
+        self.size = size
+        self.supports_streaming = supports_streaming
+        self.source = source
+
+    @property
+    def has_video(self) -> bool:
+        return self.video_codec is not None
+
+    @property
+    def is_h264_aac(self) -> bool:
+        """Déjà lisible par le lecteur intégré de Telegram (H.264 + AAC)."""
+        return self.video_codec == "h264" and self.audio_codec == "aac"
+
+    def after_transcode(self, plan: dict, size: int = 0) -> "MediaInfo":
+        """MediaInfo du MP4 produit par FFmpegExecutor selon `plan` (même géométrie, nouveaux codecs)."""
+        return MediaInfo(
+            duration=self.duration, width=self.width, height=self.height,
+            video_codec="h264" if plan["video"] != "copy" else self.video_codec,
+            audio_codec=("aac" if plan["audio"] == "aac" else self.audio_codec) if plan["audio"] else None,
+            format_name="mov,mp4,m4a,3gp,3g2,mj2",
+            size=size,
+            supports_streaming=True,
+        )
+
+    def describe(self) -> str:
+        return (
+            f"{self.format_name or '?'} {self.width}x{self.height} {self.duration:.1f}s "
+            f"v={self.video_codec or '-'} a={self.audio_codec or '-'} {self.bit_rate // 1000} kb/s"
+            f" [{self.source}]"
+        )
+
+
+def _int(value) -> int:
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+def parse_probe(data: dict) -> MediaInfo:
+    """Construit un MediaInfo depuis la sortie JSON de ffprobe."""
+    fmt = data.get("format") or {}
+    video = audio = None
+    for stream in data.get("streams") or []:
+        kind = stream.get("codec_type")
+        if kind == "video" and video is None and not (stream.get("disposition") or {}).get("attached_pic"):
+            video = stream
+        elif kind == "audio" and audio is None:
+            audio = stream
+    duration = fmt.get("duration") or (video or {}).get("duration") or 0
+    try:
+        duration = float(duration)
+    except (TypeError, ValueError):
+        duration = 0.0
+    return MediaInfo(
+        duration=duration,
+        width=_int((video or {}).get("width")),
+        height=_int((video or {}).get("height")),
+        video_codec=(video or {}).get("codec_name"),
+        audio_codec=(audio or {}).get("codec_name"),
+        format_name=fmt.get("format_name"),
+        bit_rate=_int(fmt.get("bit_rate")),
+        size=_int(fmt.get("size")),
+    )
+
+
+def info_from_document(document) -> MediaInfo | None:
+    """
+    MediaInfo depuis le DocumentAttributeVideo d'un document Telegram.
+
+    Pas de codecs dans ce cas ; None si l'attribut manque ou n'a pas de
+    dimensions, l'appelant sonde alors le fichier avec probe_media().
+    """
+    for attr in getattr(document, "attributes", None) or []:
+        if type(attr).__name__ != "DocumentAttributeVideo":
+            continue
+        width, height = _int(getattr(attr, "w", 0)), _int(getattr(attr, "h", 0))
+        if not width or not height:
+            return None
+        return MediaInfo(
+            duration=float(getattr(attr, "duration", 0) or 0),
+            width=width,
+            height=height,
+            format_name=getattr(document, "mime_type", None),
+            size=_int(getattr(document, "size", 0)),
+            supports_streaming=bool(getattr(attr, "supports_streaming", False)),
+            source="telegram",
+        )
+    return None
+
+
+async def _ffprobe(target: str, label: str, data: bytes | None, timeout: float) -> MediaInfo | None:
+    ffprobe = shutil.which("ffprobe")
+    if not ffprobe:
+        return None
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            ffprobe, "-v", "quiet", "-print_format", "json",
+            "-show_format", "-show_streams", target,
+            stdin=asyncio.subprocess.PIPE if data is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    except OSError as e:
+        logging.warning(f"ffprobe could not start: {e}")
+        return None
+    try:
+        stdout, _ = await asyncio.wait_for(proc.communicate(data), timeout=timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        logging.warning(f"ffprobe timed out after {timeout}s on {label}")
+        return None
+    except asyncio.CancelledError:
+        proc.kill()
+        await proc.wait()
+        raise
+    if proc.returncode != 0:
+        return None
+    try:
+        return parse_probe(json.loads(stdout or b"{}"))
+    except ValueError:
+        return None
+
+
+async def probe_media(path, timeout: float = PROBE_TIMEOUT) -> MediaInfo | None:
+    """
+    Un seul ffprobe asynchrone (format + streams), sans bloquer la boucle.
+
+    Renvoie None si ffprobe est absent, échoue ou dépasse `timeout`.
+    """
+    path = os.fspath(path)
+    return await _ffprobe(path, os.path.basename(path), None, timeout)
+
+
+async def probe_head(data: bytes, timeout: float = PROBE_TIMEOUT) -> MediaInfo | None:
+    """Comme probe_media(), sur le début d'un fichier passé par stdin (codecs et conteneur)."""
+    return await _ffprobe("pipe:0", "stream head", data, timeout)
+
+
+def can_normalize_thumbnails() -> bool:
+    """Pillow est installé (dépendance optionnelle)."""
+    try:
+        import PIL  # type: ignore  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def normalize_thumbnail(src, dst, max_side: int = THUMB_MAX_SIDE, max_bytes: int = THUMB_MAX_BYTES) -> bool:
+    """
+    Prépare une miniature prête à l'upload : orientation EXIF appliquée,
+    côté max `max_side`, JPEG compact sans métadonnées (qualité baissée
+    jusqu'à tenir dans `max_bytes`). Écriture atomique dans `dst`.
+
+    Bloquant : à appeler via asyncio.to_thread(). Renvoie False si Pillow
+    est absent (rien n'est écrit) ; lève une erreur si l'image est illisible.
+    """
+    try:
+        from PIL import Image, ImageOps  # type: ignore
+    except ImportError:
+        return False
+    with Image.open(src) as im:
+        im = ImageOps.exif_transpose(im)
+        if im.mode in ("RGBA", "LA", "P"):
+            # Transparence sur fond blanc : le JPEG n'a pas de canal alpha
+            im = im.convert("RGBA")
+            background = Image.new("RGB", im.size, (255, 255, 255))
+            background.paste(im, mask=im.getchannel("A"))
+            im = background
+        else:
+            im = im.convert("RGB")
+        im.thumbnail((max_side, max_side), Image.LANCZOS)
+        # Nouvelle image : ni EXIF, ni ICC, ni commentaires
+        clean = Image.new("RGB", im.size)
+        clean.paste(im)
+    data = b""
+    for quality in (85, 75, 65, 50, 35):
+        buf = io.BytesIO()
+        clean.save(buf, "JPEG", quality=quality, optimize=True)
+        data = buf.getvalue()
+        if len(data) <= max_bytes:
+            break
+    dst = os.fspath(dst)
+    tmp = f"{dst}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, dst)
+    return True
+
+
+class FFmpegError(RuntimeError):
+    pass
+
+
+class FFmpegExecutor:
+    """
+    Exécuteur des jobs ffmpeg, hors de la boucle d'événements.
+
+    Chaque job est un sous-processus asyncio : jamais de subprocess.run
+    bloquant. Les encodages prennent un des `slots` (limite CPU globale)
+    et reçoivent `threads` threads ; les remux (copie de flux) n'en ont pas
+    besoin. Les encodages à la volée (stream) ont leurs `stream_slots` à
+    part, pour ne jamais bloquer les jobs sur disque. Timeout et annulation
+    tuent le processus ; kill_all() à l'arrêt.
+    """
+
+    def __init__(self, slots: int = FFMPEG_SLOTS, threads: int = FFMPEG_THREADS,
+                 timeout: float = FFMPEG_TIMEOUT,
+                 stream_timeout: float = FFMPEG_STREAM_TIMEOUT,
+                 stream_slots: int = FFMPEG_STREAM_SLOTS,
+                 stream_slot_wait: float = FFMPEG_STREAM_SLOT_WAIT) -> None:
+        self.slots = max(1, int(slots))
+        self.threads = max(1, int(threads))
+        self.timeout = float(timeout)
+        self.stream_timeout = float(stream_timeout)
+        self.stream_slots = max(1, int(stream_slots))
+        self.stream_slot_wait = max(0.0, float(stream_slot_wait))
+        self._cpu = asyncio.Semaphore(self.slots)
+        self._stream_cpu = asyncio.Semaphore(self.stream_slots)
+        self._procs: set = set()
+
+    @staticmethod
+    def available() -> bool:
+        return shutil.which("ffmpeg") is not None
+
+    @staticmethod
+    def plan(info: MediaInfo | None) -> dict | None:
+        """
+        Codecs à appliquer par flux, ou None si rien à faire.
+
+        Un flux déjà compatible est copié tel quel ; si tout est copié,
+        c'est un simple remux vers MP4 (+faststart), sinon un transcodage
+        limité aux flux incompatibles.
+        """
+        if info is None or not info.has_video:
+            return None
+        video = "copy" if info.video_codec in COMPATIBLE_VIDEO else "libx264"
+        audio = None
+        if info.audio_codec:
+            audio = "copy" if info.audio_codec in COMPATIBLE_AUDIO else "aac"
+        is_mp4 = "mp4" in (info.format_name or "")
+        if video == "copy" and audio in (None, "copy") and is_mp4:
+            return None
+        return {"video": video, "audio": audio}
+
+    @staticmethod
+    def is_remux(plan: dict) -> bool:
+        return plan["video"] == "copy" and plan["audio"] in (None, "copy")
+
+    def build_args(self, src: str, dst: str, plan: dict, fragmented: bool = False) -> list[str]:
+        """Arguments ffmpeg ; fragmented=True produit un MP4 fragmenté écrivable sur un pipe."""
+        args = ["-i", src, "-map", "0:v:0", "-c:v", plan["video"]]
+        if plan["video"] != "copy":
+            args += ["-preset", "fast", "-pix_fmt", "yuv420p", "-threads", str(self.threads)]
+        if plan["audio"]:
+            args += ["-map", "0:a:0", "-c:a", plan["audio"]]
+        movflags = "frag_keyframe+empty_moov+default_base_moof" if fragmented else "+faststart"
+        args += ["-movflags", movflags, "-f", "mp4", dst]
+        return args
+
+    async def run(self, args: list[str], cpu: bool = True, timeout: float | None = None) -> None:
+        """Lance `ffmpeg args` ; lève FFmpegError sur code non nul ou timeout."""
+        ffmpeg = shutil.which("ffmpeg")
+        if not ffmpeg:
+            raise FFmpegError("ffmpeg not found")
+        timeout = self.timeout if timeout is None else timeout
+        if cpu:
+            await self._cpu.acquire()
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                ffmpeg, "-hide_banner", "-nostdin", "-loglevel", "error", "-y", *args,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            self._procs.add(proc)
+            try:
+                _, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+            except asyncio.TimeoutError:
+                await self._terminate(proc)
+                raise FFmpegError(f"ffmpeg timed out after {timeout:.0f}s")
+            except asyncio.CancelledError:
+                await self._terminate(proc)
+                raise
+            finally:
+                self._procs.discard(proc)
+            if proc.returncode != 0:
+                tail = (stderr or b"").decode(errors="replace").strip()[-300:]
+                raise FFmpegError(f"ffmpeg exited with {proc.returncode}: {tail}")
+        finally:
+            if cpu:
+                self._cpu.release()
+
+    async def convert(self, src: str, dst: str, plan: dict) -> None:
+        """Remux ou transcodage selon `plan` ; supprime une sortie partielle en cas d'échec."""
+        try:
+            await self.run(self.build_args(src, dst, plan), cpu=not self.is_remux(plan))
+        except BaseException:
+            try:
+                os.remove(dst)
+            except OSError:
+                pass
+            raise
+
+    async def stream(self, args: list[str], chunks, cpu: bool = True,
+                     timeout: float | None = None, read_size: int = 512 * 1024):
+        """
+        Générateur asynchrone : envoie `chunks` sur le stdin de `ffmpeg args`
+        et produit sa sortie stdout au fil de l'eau.
+
+        Un encodage (cpu=True) prend un des `stream_slots`. Une erreur de la
+        source est relancée telle quelle ; pas de slot libre après
+        `stream_slot_wait`, un code de sortie non nul ou le dépassement de
+        `timeout` (stream_timeout par défaut, compté une fois le slot obtenu)
+        lèvent FFmpegError.
+        """
+        ffmpeg = shutil.which("ffmpeg")
+        if not ffmpeg:
+            raise FFmpegError("ffmpeg not found")
+        loop = asyncio.get_running_loop()
+        if cpu:
+            try:
+                await asyncio.wait_for(self._stream_cpu.acquire(), timeout=self.stream_slot_wait)
+            except asyncio.TimeoutError:
+                raise FFmpegError(f"no ffmpeg stream slot free after {self.stream_slot_wait:.0f}s")
+        deadline = loop.time() + (self.stream_timeout if timeout is None else timeout)
+        proc = feeder = drainer = None
+        source_error: list[BaseException] = []
+        stderr_tail = bytearray()
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                ffmpeg, "-hide_banner", "-loglevel", "error", "-y", *args,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            self._procs.add(proc)
+
+            async def feed():
+                try:
+                    async for chunk in chunks:
+                        proc.stdin.write(chunk)
+                        await proc.stdin.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # ffmpeg est sorti : son code de retour dira pourquoi
+                except Exception as e:
+                    source_error.append(e)
+                    proc.kill()
+                finally:
+                    try:
+                        proc.stdin.close()
+                    except Exception:
+                        pass
+
+            async def drain_stderr():
+                while True:
+                    line = await proc.stderr.read(4096)
+                    if not line:
+                        return
+                    stderr_tail.extend(line)
+                    del stderr_tail[:-2000]
+
+            feeder = asyncio.ensure_future(feed())
+            drainer = asyncio.ensure_future(drain_stderr())
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise FFmpegError("ffmpeg timed out")
+                try:
+                    data = await asyncio.wait_for(proc.stdout.read(read_size), timeout=remaining)
+                except asyncio.TimeoutError:
+                    raise FFmpegError("ffmpeg timed out")
+                if not data:
+                    break
+                yield data
+            await feeder
+            await proc.wait()
+            await drainer
+            if source_error:
+                raise source_error[0]
+            if proc.returncode != 0:
+                tail = bytes(stderr_tail).decode(errors="replace").strip()[-300:]
+                raise FFmpegError(f"ffmpeg exited with {proc.returncode}: {tail}")
+        finally:
+            for task in (feeder, drainer):
+                if task is not None and not task.done():
+                    task.cancel()
+            if proc is not None:
+                await self._terminate(proc)
+                self._procs.discard(proc)
+            if cpu:
+                self._stream_cpu.release()
+
+    @staticmethod
+    async def _terminate(proc) -> None:
+        if proc.returncode is not None:
+            return
+        proc.terminate()
+        try:
+            await asyncio.wait_for(proc.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+
+    async def kill_all(self) -> None:
+        for proc in list(self._procs):
+            await self._terminate(proc)
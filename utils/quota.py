@@ -2,11 +2,59 @@
 from __future__ import annotations
 
 import os
+import asyncio
+import logging
+import time
+import uuid
 import datetime as dt
+from contextlib import asynccontextmanager
 from zoneinfo import ZoneInfo
 import aiosqlite
 
 DB_PATH = os.getenv("QUOTA_DB_PATH", "quota.db")
+POOL_SIZE = int(os.getenv("QUOTA_POOL_SIZE", "4"))
+FLUSH_INTERVAL = float(os.getenv("QUOTA_FLUSH_INTERVAL", "5"))
+RETENTION_DAYS = int(os.getenv("QUOTA_RETENTION_DAYS", "30"))
+COMPACT_INTERVAL = float(os.getenv("QUOTA_COMPACT_INTERVAL", "21600"))
+# Les derniers fichiers plus vieux que cette fenêtre (≥ au plus long cooldown)
+# sont retirés de la mémoire après un flush ; ils restent lisibles en base.
+LAST_FILE_WINDOW = float(os.getenv("QUOTA_LAST_FILE_WINDOW", "86400"))
+
+# Requêtes gardées en constantes : sqlite3 met en cache la requête préparée
+# par texte SQL, chaque connexion du pool les réutilise donc sans re-parser.
+_SQL_SELECT_COUNTER = "SELECT used, bytes FROM quotas WHERE user_id=? AND day=?"
+_SQL_UPSERT_COUNTER = (
+    "INSERT INTO quotas (user_id, day, used, bytes) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(user_id, day) DO UPDATE SET used = excluded.used, bytes = excluded.bytes"
+)
+_SQL_SELECT_LAST_FILE = "SELECT last_file_ts FROM quota_cooldowns WHERE user_id=?"
+_SQL_UPSERT_LAST_FILE = (
+    "INSERT INTO quota_cooldowns (user_id, last_file_ts) VALUES (?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET last_file_ts = excluded.last_file_ts"
+)
+_SQL_SELECT_DAY = "SELECT user_id, used, bytes FROM quotas WHERE day=?"
+_SQL_SELECT_LAST_FILES_SINCE = (
+    "SELECT user_id, last_file_ts FROM quota_cooldowns WHERE last_file_ts >= ?"
+)
+_SQL_DISTINCT_USERS = (
+    "SELECT user_id FROM quotas UNION SELECT user_id FROM quota_monthly"
+)
+# Les lignes journalières plus anciennes que la rétention sont cumulées par mois
+_SQL_ROLLUP_MONTHLY = (
+    "INSERT INTO quota_monthly (user_id, month, used, bytes) "
+    "SELECT user_id, substr(day, 1, 7), SUM(used), SUM(bytes) FROM quotas WHERE day < ? "
+    "GROUP BY user_id, substr(day, 1, 7) "
+    "ON CONFLICT(user_id, month) DO UPDATE SET "
+    "used = used + excluded.used, bytes = bytes + excluded.bytes"
+)
+_SQL_DELETE_BEFORE = "DELETE FROM quotas WHERE day < ?"
+
+async def _ensure_column(db: aiosqlite.Connection, table: str, column: str, decl: str) -> None:
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    cols = {row[1] for row in await cur.fetchall()}
+    await cur.close()
+    if column not in cols:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
 
 async def _ensure_schema(db: aiosqlite.Connection) -> None:
     await db.execute(
@@ -15,10 +63,36 @@ async def _ensure_schema(db: aiosqlite.Connection) -> None:
             user_id INTEGER NOT NULL,
             day TEXT NOT NULL,
             used INTEGER NOT NULL DEFAULT 0,
+            bytes INTEGER NOT NULL DEFAULT 0,
             PRIMARY KEY (user_id, day)
         )
         """
     )
+    await _ensure_column(db, "quotas", "bytes", "INTEGER NOT NULL DEFAULT 0")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_quotas_day ON quotas (day)")
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS quota_monthly (
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            used INTEGER NOT NULL DEFAULT 0,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, month)
+        )
+        """
+    )
+    await _ensure_column(db, "quota_monthly", "bytes", "INTEGER NOT NULL DEFAULT 0")
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS quota_cooldowns (
+            user_id INTEGER PRIMARY KEY,
+            last_file_ts REAL NOT NULL
+        )
+        """
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_quota_cooldowns_ts ON quota_cooldowns (last_file_ts)"
+    )
     await db.commit()
 
 async def init_quota_db(db_path: str = DB_PATH) -> None:
@@ -50,6 +124,9 @@ async def increment_if_under_limit(
     - reset_time_str = heure locale de reset (ex: '00:00 UTC')
     - just_reached_limit=True si cette action vient d'atteindre la limite
     - is_admin=True pour bypass les quotas (illimité)
+
+    Ouvre une connexion à chaque appel : réservé aux scripts ponctuels,
+    le bot passe par un QuotaStore ouvert une seule fois au démarrage.
     """
     # Admins ont des quotas illimités
     if is_admin:
@@ -86,3 +163,529 @@ async def increment_if_under_limit(
         remaining = max(daily_limit - new_used, 0)
         just_reached_limit = (new_used >= daily_limit)
         return True, remaining, _reset_time_str(tz_name), just_reached_limit
+
+
+class QuotaReservation:
+    """
+    Résultat de QuotaStore.reserve().
+    - token = identifiant à passer à commit()/refund() (None si refusé ou admin)
+    - ok, remaining, reset_time, just_reached_limit : même sens que increment_if_under_limit
+    - reason = 'actions', 'bytes' ou 'cooldown' si refusé, sinon None
+    - retry_after = secondes restantes avant la fin du cooldown (si reason='cooldown')
+    """
+
+    __slots__ = (
+        "token", "ok", "remaining", "reset_time", "just_reached_limit",
+        "reason", "retry_after",
+    )
+
+    def __init__(
+        self, token, ok, remaining, reset_time, just_reached_limit,
+        reason=None, retry_after=0.0,
+    ):
+        self.token = token
+        self.ok = ok
+        self.remaining = remaining
+        self.reset_time = reset_time
+        self.just_reached_limit = just_reached_limit
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class QuotaStore:
+    """
+    Moteur de quotas longue durée, créé une fois au démarrage.
+
+    Suit ensemble, par utilisateur, les actions et les octets du jour ainsi
+    que l'heure du dernier fichier (cooldown). reserve() vérifie les trois
+    limites et débite en une seule étape.
+
+    Garde un petit pool de connexions SQLite en mode WAL ; le schéma est
+    vérifié une seule fois à l'ouverture et les requêtes sont préparées
+    d'avance sur chaque connexion.
+
+    Les compteurs vivent en mémoire : un débit ne touche pas SQLite. Chaque
+    nouvelle valeur est ajoutée à un journal (append-only) puis les valeurs
+    modifiées sont écrites par lots toutes les `flush_interval` secondes.
+    Au redémarrage le journal est rejoué avant toute lecture, un crash ne
+    perd donc aucun débit.
+    """
+
+    def __init__(
+        self,
+        db_path: str = DB_PATH,
+        tz_name: str = "UTC",
+        pool_size: int = POOL_SIZE,
+        flush_interval: float = FLUSH_INTERVAL,
+        retention_days: int = RETENTION_DAYS,
+        compact_interval: float = COMPACT_INTERVAL,
+        last_file_window: float = LAST_FILE_WINDOW,
+    ) -> None:
+        self.db_path = db_path
+        self.tz_name = tz_name
+        self.pool_size = max(1, int(pool_size))
+        self.flush_interval = max(0.1, float(flush_interval))
+        self.retention_days = max(1, int(retention_days))
+        self.compact_interval = max(60.0, float(compact_interval))
+        self.last_file_window = max(60.0, float(last_file_window))
+        self.journal_path = db_path + ".journal"
+        self._pool: asyncio.Queue | None = None
+        self._conns: list[aiosqlite.Connection] = []
+        self._open_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: asyncio.Task | None = None
+        self._compact_task: asyncio.Task | None = None
+        self._journal = None
+        # (user_id, day) -> [actions, bytes]
+        self._counters: dict[tuple[int, str], list[int]] = {}
+        self._dirty: set[tuple[int, str]] = set()
+        # user_id -> timestamp du dernier fichier (0.0 si aucun)
+        self._last_file: dict[int, float] = {}
+        self._dirty_last_file: set[int] = set()
+        # token -> (user_id, day, octets réservés, last_file_ts précédent, last_file_ts posé)
+        self._reservations: dict[str, tuple[int, str, int, float, float]] = {}
+
+    async def open(self) -> None:
+        """Ouvre le pool, rejoue le journal et lance le flush périodique (idempotent)."""
+        async with self._open_lock:
+            if self._pool is not None:
+                return
+            folder = os.path.dirname(self.db_path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            pool: asyncio.Queue = asyncio.Queue()
+            for i in range(self.pool_size):
+                db = await aiosqlite.connect(
+                    self.db_path, isolation_level=None, cached_statements=32
+                )
+                await db.execute("PRAGMA journal_mode=WAL")
+                await db.execute("PRAGMA synchronous=NORMAL")
+                await db.execute("PRAGMA busy_timeout=5000")
+                if i == 0:
+                    await _ensure_schema(db)
+                await self._prepare(db)
+                self._conns.append(db)
+                pool.put_nowait(db)
+            self._pool = pool
+            self._replay_journal()
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+            self._flush_task = asyncio.create_task(self._flush_loop())
+            self._compact_task = asyncio.create_task(self._compact_loop())
+        # Les débits rejoués sont écrits tout de suite
+        await self.flush()
+
+    async def close(self) -> None:
+        """Écrit les compteurs en attente puis ferme le pool."""
+        for task in (self._compact_task, self._flush_task):
+            if task is None:
+                continue
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._compact_task = None
+        self._flush_task = None
+        if self._pool is not None:
+            await self.flush()
+        async with self._open_lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            for db in self._conns:
+                try:
+                    await db.close()
+                except Exception:
+                    pass
+            self._conns = []
+            self._pool = None
+
+    @staticmethod
+    async def _prepare(db: aiosqlite.Connection) -> None:
+        # Exécute chaque requête une fois dans une transaction annulée :
+        # sqlite3 la compile et la garde dans son cache de statements.
+        await db.execute("BEGIN")
+        try:
+            await db.execute(_SQL_SELECT_COUNTER, (-1, ""))
+            await db.execute(_SQL_UPSERT_COUNTER, (-1, "", 0, 0))
+            await db.execute(_SQL_SELECT_LAST_FILE, (-1,))
+            await db.execute(_SQL_UPSERT_LAST_FILE, (-1, 0.0))
+            await db.execute(_SQL_SELECT_DAY, ("",))
+            await db.execute(_SQL_SELECT_LAST_FILES_SINCE, (0.0,))
+            await db.execute(_SQL_DISTINCT_USERS)
+        finally:
+            await db.rollback()
+
+    @asynccontextmanager
+    async def _conn(self):
+        if self._pool is None:
+            await self.open()
+        db = await self._pool.get()
+        try:
+            yield db
+        finally:
+            self._pool.put_nowait(db)
+
+    # --- Journal ---------------------------------------------------------
+
+    def _replay_journal(self) -> None:
+        # Lignes en valeurs absolues, dans l'ordre d'écriture :
+        #   "q user_id day actions bytes"  (compteur du jour)
+        #   "c user_id last_file_ts"       (cooldown)
+        # La dernière ligne d'une clé fait foi, rejouer une ligne déjà
+        # écrite en base est donc sans effet.
+        for path in (self.journal_path + ".1", self.journal_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    parts = line.split()
+                    try:
+                        if len(parts) == 5 and parts[0] == "q":
+                            key = (int(parts[1]), parts[2])
+                            self._counters[key] = [int(parts[3]), int(parts[4])]
+                            self._dirty.add(key)
+                        elif len(parts) == 3 and parts[0] == "c":
+                            uid = int(parts[1])
+                            self._last_file[uid] = float(parts[2])
+                            self._dirty_last_file.add(uid)
+                    except ValueError:
+                        continue
+
+    def _journal_line(self, line: str) -> None:
+        if self._journal is None:
+            return
+        self._journal.write(line + "\n")
+        self._journal.flush()
+
+    def _set_counter(self, key: tuple[int, str], actions: int, nbytes: int) -> None:
+        self._counters[key] = [actions, nbytes]
+        self._dirty.add(key)
+        self._journal_line(f"q {key[0]} {key[1]} {actions} {nbytes}")
+
+    def _set_last_file(self, user_id: int, ts: float) -> None:
+        self._last_file[user_id] = ts
+        self._dirty_last_file.add(user_id)
+        self._journal_line(f"c {user_id} {ts:.3f}")
+
+    def _rotate_journal(self) -> None:
+        # Le journal courant devient ".1" le temps du flush ; les débits
+        # qui arrivent pendant l'écriture vont dans un journal neuf.
+        if self._journal is not None:
+            self._journal.close()
+        rotated = self.journal_path + ".1"
+        if os.path.exists(self.journal_path):
+            if os.path.exists(rotated):
+                with open(self.journal_path, "r", encoding="utf-8") as src, \
+                        open(rotated, "a", encoding="utf-8") as dst:
+                    dst.write(src.read())
+                os.remove(self.journal_path)
+            else:
+                os.replace(self.journal_path, rotated)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    # --- Flush -------------------------------------------------------------
+
+    async def flush(self) -> int:
+        """Écrit en une transaction les valeurs modifiées. Retourne le nombre de lignes."""
+        async with self._flush_lock:
+            if not self._dirty and not self._dirty_last_file:
+                return 0
+            counters = [
+                (uid, day, *self._counters[(uid, day)]) for uid, day in self._dirty
+            ]
+            last_files = [(uid, self._last_file[uid]) for uid in self._dirty_last_file]
+            self._dirty.clear()
+            self._dirty_last_file.clear()
+            self._rotate_journal()
+            try:
+                async with self._conn() as db:
+                    await db.execute("BEGIN IMMEDIATE")
+                    try:
+                        await db.executemany(_SQL_UPSERT_COUNTER, counters)
+                        await db.executemany(_SQL_UPSERT_LAST_FILE, last_files)
+                        await db.commit()
+                    except Exception:
+                        await db.rollback()
+                        raise
+            except Exception:
+                # Rien n'est perdu : les clés redeviennent sales et le journal
+                # rotaté est conservé pour le prochain essai ou un rejeu.
+                self._dirty.update((uid, day) for uid, day, _, _ in counters)
+                self._dirty_last_file.update(uid for uid, _ in last_files)
+                raise
+            try:
+                os.remove(self.journal_path + ".1")
+            except FileNotFoundError:
+                pass
+            self._evict_old_days()
+            self._evict_old_last_files()
+            return len(counters) + len(last_files)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Quota flush failed: {e}")
+
+    # --- Rétention ---------------------------------------------------------
+
+    async def compact(self, retention_days: int | None = None) -> int:
+        """
+        Cumule dans quota_monthly les lignes journalières plus vieilles que la
+        fenêtre de rétention, puis les supprime. Retourne le nombre de lignes retirées.
+        """
+        days = self.retention_days if retention_days is None else max(1, int(retention_days))
+        today = dt.datetime.now(ZoneInfo(self.tz_name)).date()
+        cutoff = (today - dt.timedelta(days=days)).strftime("%Y-%m-%d")
+        await self.flush()
+        async with self._flush_lock:
+            async with self._conn() as db:
+                await db.execute("BEGIN IMMEDIATE")
+                try:
+                    await db.execute(_SQL_ROLLUP_MONTHLY, (cutoff,))
+                    cur = await db.execute(_SQL_DELETE_BEFORE, (cutoff,))
+                    removed = cur.rowcount
+                    await cur.close()
+                    await db.commit()
+                except Exception:
+                    await db.rollback()
+                    raise
+        if removed:
+            logging.info(f"Quota compaction: {removed} daily rows rolled up before {cutoff}")
+        return removed
+
+    async def _compact_loop(self) -> None:
+        while True:
+            try:
+                await self.compact()
+            except Exception as e:
+                logging.error(f"Quota compaction failed: {e}")
+            await asyncio.sleep(self.compact_interval)
+
+    def _evict_old_days(self) -> None:
+        today = _today_str(self.tz_name)
+        for key in [k for k in self._counters if k[1] != today and k not in self._dirty]:
+            self._counters.pop(key, None)
+
+    def _evict_old_last_files(self) -> None:
+        # Simple cache : une entrée retirée est relue en base au besoin
+        cutoff = time.time() - self.last_file_window
+        for uid in [
+            u for u, ts in self._last_file.items()
+            if ts < cutoff and u not in self._dirty_last_file
+        ]:
+            self._last_file.pop(uid, None)
+
+    # --- Compteurs ---------------------------------------------------------
+
+    async def _load(self, user_id: int, day: str) -> tuple[int, str]:
+        key = (user_id, day)
+        if key in self._counters:
+            return key
+        async with self._conn() as db:
+            cur = await db.execute(_SQL_SELECT_COUNTER, (user_id, day))
+            row = await cur.fetchone()
+            await cur.close()
+        # Un autre appel a pu charger la clé pendant l'await
+        self._counters.setdefault(key, [int(row[0]), int(row[1])] if row else [0, 0])
+        return key
+
+    async def _load_last_file(self, user_id: int) -> float:
+        if user_id in self._last_file:
+            return self._last_file[user_id]
+        async with self._conn() as db:
+            cur = await db.execute(_SQL_SELECT_LAST_FILE, (user_id,))
+            row = await cur.fetchone()
+            await cur.close()
+        return self._last_file.setdefault(user_id, float(row[0]) if row else 0.0)
+
+    async def warm(self, cooldown_window: float = 86400) -> int:
+        """
+        Précharge en mémoire les compteurs du jour et les derniers fichiers
+        récents (index sur day / last_file_ts). Retourne le nombre d'utilisateurs chargés.
+        """
+        day = _today_str(self.tz_name)
+        async with self._conn() as db:
+            cur = await db.execute(_SQL_SELECT_DAY, (day,))
+            rows = await cur.fetchall()
+            await cur.close()
+            cur = await db.execute(_SQL_SELECT_LAST_FILES_SINCE, (time.time() - cooldown_window,))
+            last_files = await cur.fetchall()
+            await cur.close()
+        # setdefault : les valeurs rejouées du journal restent prioritaires
+        for uid, used, nbytes in rows:
+            self._counters.setdefault((int(uid), day), [int(used), int(nbytes)])
+        for uid, ts in last_files:
+            self._last_file.setdefault(int(uid), float(ts))
+        return len(rows)
+
+    async def usage(self, user_id: int) -> dict:
+        """
+        Consommation du jour : {'actions', 'bytes', 'last_file_ts'}.
+        Servie depuis la mémoire une fois l'utilisateur chargé.
+        """
+        last_file_ts = await self._load_last_file(user_id)
+        # Aucun await entre _load et la lecture : un flush ne peut pas évincer la clé
+        key = await self._load(user_id, _today_str(self.tz_name))
+        actions, nbytes = self._counters[key]
+        return {'actions': actions, 'bytes': nbytes, 'last_file_ts': last_file_ts}
+
+    async def check(
+        self, user_id: int, daily_limit: int, is_admin: bool = False
+    ) -> tuple[bool, int, str]:
+        """Retourne (ok, remaining, reset_time_str) sans rien consommer."""
+        reset = _reset_time_str(self.tz_name)
+        if is_admin:
+            return True, 999999, reset
+        used = (await self.usage(user_id))['actions']
+        remaining = max(daily_limit - used, 0)
+        return remaining > 0, remaining, reset
+
+    async def increment(
+        self, user_id: int, daily_limit: int, is_admin: bool = False
+    ) -> tuple[bool, int, str, bool]:
+        """
+        Même contrat que increment_if_under_limit, servi depuis la mémoire :
+        le test et l'incrément se font sans await entre eux, donc atomiquement.
+        """
+        reset = _reset_time_str(self.tz_name)
+        if is_admin:
+            return True, 999999, reset, False
+        if daily_limit <= 0:
+            return False, 0, reset, False
+
+        key = await self._load(user_id, _today_str(self.tz_name))
+        used, nbytes = self._counters[key]
+        if used >= daily_limit:
+            return False, 0, reset, False
+        new_used = used + 1
+        self._set_counter(key, new_used, nbytes)
+        remaining = max(daily_limit - new_used, 0)
+        return True, remaining, reset, new_used >= daily_limit
+
+    # --- Réservations ------------------------------------------------------
+
+    async def reserve(
+        self,
+        user_id: int,
+        daily_limit: int,
+        nbytes: int = 0,
+        byte_limit: int | None = None,
+        cooldown: float = 0,
+        is_admin: bool = False,
+    ) -> QuotaReservation:
+        """
+        Débite une action (et `nbytes` octets) une seule fois pour tout le
+        cycle de vie d'un fichier, après avoir vérifié ensemble la limite
+        d'actions, la limite d'octets et le cooldown. Les étapes suivantes ne
+        font que commit() ou refund() le token.
+        """
+        reset = _reset_time_str(self.tz_name)
+        if is_admin:
+            return QuotaReservation(None, True, 999999, reset, False)
+        if daily_limit <= 0:
+            return QuotaReservation(None, False, 0, reset, False, reason='actions')
+
+        day = _today_str(self.tz_name)
+        prev_ts = await self._load_last_file(user_id)
+        key = await self._load(user_id, day)
+
+        # Plus aucun await à partir d'ici : vérification et débit sont atomiques
+        nbytes = max(int(nbytes or 0), 0)
+        used, used_bytes = self._counters[key]
+        now = time.time()
+        if used >= daily_limit:
+            return QuotaReservation(None, False, 0, reset, False, reason='actions')
+        if byte_limit is not None and used_bytes + nbytes > byte_limit:
+            return QuotaReservation(
+                None, False, max(daily_limit - used, 0), reset, False, reason='bytes'
+            )
+        if cooldown and prev_ts and now - prev_ts < cooldown:
+            return QuotaReservation(
+                None, False, max(daily_limit - used, 0), reset, False,
+                reason='cooldown', retry_after=cooldown - (now - prev_ts),
+            )
+
+        new_used = used + 1
+        self._set_counter(key, new_used, used_bytes + nbytes)
+        self._set_last_file(user_id, now)
+        token = uuid.uuid4().hex
+        self._reservations[token] = (user_id, day, nbytes, prev_ts, now)
+        remaining = max(daily_limit - new_used, 0)
+        return QuotaReservation(token, True, remaining, reset, new_used >= daily_limit)
+
+    async def charge_bytes(
+        self, token: str | None, nbytes: int, byte_limit: int | None = None
+    ) -> bool | None:
+        """
+        Ajoute `nbytes` octets à une réservation existante, si la limite
+        d'octets le permet. Ils suivent ensuite le token : gardés par
+        commit(), rendus par refund(). Retourne False si la limite est
+        dépassée, None si le token n'existe plus (déjà commit ou refund).
+        """
+        if not token:
+            # Admin (ou aucune réservation) : rien à débiter
+            return True
+        entry = self._reservations.get(token)
+        if entry is None:
+            return None
+        user_id, day, reserved, prev_ts, set_ts = entry
+        nbytes = max(int(nbytes or 0), 0)
+        key = await self._load(user_id, day)
+        # Plus aucun await : vérification et débit sont atomiques
+        if token not in self._reservations:
+            return None
+        actions, used_bytes = self._counters[key]
+        if byte_limit is not None and used_bytes + nbytes > byte_limit:
+            return False
+        self._set_counter(key, actions, used_bytes + nbytes)
+        self._reservations[token] = (user_id, day, reserved + nbytes, prev_ts, set_ts)
+        return True
+
+    async def commit(self, token: str | None, nbytes: int | None = None) -> bool:
+        """
+        Confirme une réservation : l'action reste débitée. Si `nbytes` est
+        donné et inférieur aux octets réservés, la différence est rendue.
+        """
+        if not token:
+            return False
+        entry = self._reservations.pop(token, None)
+        if entry is None:
+            return False
+        user_id, day, reserved, _, _ = entry
+        if nbytes is not None and nbytes < reserved:
+            key = await self._load(user_id, day)
+            actions, used_bytes = self._counters[key]
+            self._set_counter(key, actions, max(used_bytes - (reserved - nbytes), 0))
+        return True
+
+    async def refund(self, token: str | None) -> bool:
+        """Annule une réservation (échec, annulation) : rend l'action, les octets et le cooldown."""
+        if not token:
+            return False
+        entry = self._reservations.pop(token, None)
+        if entry is None:
+            return False
+        user_id, day, reserved, prev_ts, set_ts = entry
+        key = await self._load(user_id, day)
+        actions, used_bytes = self._counters[key]
+        self._set_counter(key, max(actions - 1, 0), max(used_bytes - reserved, 0))
+        # Ne remet l'ancien cooldown que si aucun fichier plus récent ne l'a remplacé
+        if self._last_file.get(user_id) == set_ts:
+            self._set_last_file(user_id, prev_ts)
+        return True
+
+    # --- Requêtes d'ensemble -------------------------------------------------
+
+    async def user_ids(self) -> set[int]:
+        """user_id connus des quotas (journalier + cumuls mensuels)."""
+        async with self._conn() as db:
+            cur = await db.execute(_SQL_DISTINCT_USERS)
+            rows = await cur.fetchall()
+            await cur.close()
+        ids = {int(r[0]) for r in rows}
+        ids.update(uid for uid, _ in self._dirty)
+        return ids
@@ -0,0 +1,151 @@
+# utils/statefile.py
+from __future__ import annotations
+
+import os
+import copy
+import json
+import asyncio
+import logging
+import tempfile
+import threading
+
+WRITE_INTERVAL = float(os.getenv("STATE_WRITE_INTERVAL", "2"))
+
+def write_json_atomic(path, data, **dump_kwargs) -> None:
+    """Écrit `data` dans un fichier temporaire du même dossier puis os.replace()."""
+    path = os.fspath(path)
+    folder = os.path.dirname(path) or "."
+    dump_kwargs.setdefault("indent", 2)
+    dump_kwargs.setdefault("ensure_ascii", False)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp_", suffix=".json", dir=folder)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, **dump_kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class StateFileWriter:
+    """
+    Écrivain partagé des fichiers d'état JSON.
+
+    schedule() garde seulement le dernier contenu demandé pour un fichier ;
+    une écriture par fichier et par intervalle est faite dans un thread,
+    via fichier temporaire + os.replace (jamais de fichier à moitié écrit).
+    flush() écrit tout ce qui reste, à appeler à l'arrêt. pending() dit si
+    une écriture est encore à venir ou en cours ; `on_written` est rappelé
+    (dans la boucle) après chaque écriture réussie du fichier.
+
+    Annuler une tâche n'arrête pas un thread déjà lancé : chaque écriture
+    porte donc un numéro de séquence, et les écritures d'un même fichier
+    sont sérialisées ; une copie plus ancienne n'écrase jamais une plus récente.
+    """
+
+    def __init__(self, interval: float = WRITE_INTERVAL) -> None:
+        self.interval = max(0.0, float(interval))
+        self._pending: dict[str, object] = {}
+        self._timers: dict[str, asyncio.Task] = {}
+        self._write_lock = asyncio.Lock()
+        self._seq = 0
+        # path -> (verrou des threads d'écriture, séquence écrite en dernier)
+        self._path_locks: dict[str, threading.Lock] = {}
+        self._written: dict[str, int] = {}
+        self._writing: dict[str, int] = {}
+        self._in_flight: set[asyncio.Future] = set()
+        self._callbacks: dict[str, object] = {}
+
+    def schedule(self, path, data, on_written=None) -> None:
+        """Programme l'écriture de `data` (copié tout de suite) dans `path`."""
+        key = os.fspath(path)
+        snapshot = copy.deepcopy(data)
+        if on_written is not None:
+            self._callbacks[key] = on_written
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Pas de boucle (import, script) : écriture directe
+            write_json_atomic(key, snapshot)
+            self._notify(key)
+            return
+        self._pending[key] = snapshot
+        timer = self._timers.get(key)
+        if timer is None or timer.done():
+            self._timers[key] = loop.create_task(self._delayed_write(key))
+
+    async def _delayed_write(self, key: str) -> None:
+        await asyncio.sleep(self.interval)
+        self._timers.pop(key, None)
+        await self._write(key)
+
+    async def _write(self, key: str) -> None:
+        async with self._write_lock:
+            if key not in self._pending:
+                return
+            data = self._pending.pop(key)
+            self._seq += 1
+            seq = self._seq
+            lock = self._path_locks.setdefault(key, threading.Lock())
+            fut = asyncio.ensure_future(
+                asyncio.to_thread(self._write_if_newer, key, data, seq, lock)
+            )
+            # Suivie jusqu'au bout, même si la tâche appelante est annulée
+            self._writing[key] = self._writing.get(key, 0) + 1
+            self._in_flight.add(fut)
+            fut.add_done_callback(lambda f, key=key: self._write_done(key, f))
+            try:
+                await asyncio.shield(fut)
+            except Exception:
+                pass  # journalisé par _write_done
+
+    def _write_done(self, key: str, fut: asyncio.Future) -> None:
+        self._in_flight.discard(fut)
+        self._writing[key] -= 1
+        if not self._writing[key]:
+            del self._writing[key]
+        if fut.cancelled():
+            return
+        if fut.exception() is not None:
+            logging.error(f"Error saving {os.path.basename(key)}: {fut.exception()}")
+        elif fut.result():
+            self._notify(key)
+
+    def _write_if_newer(self, key: str, data, seq: int, lock: threading.Lock) -> bool:
+        # Exécuté dans un thread : os.replace seulement si rien de plus récent n'est passé
+        with lock:
+            if self._written.get(key, 0) > seq:
+                return False
+            write_json_atomic(key, data)
+            self._written[key] = seq
+            return True
+
+    def _notify(self, key: str) -> None:
+        callback = self._callbacks.get(key)
+        if callback is None:
+            return
+        try:
+            callback()
+        except Exception as e:
+            logging.error(f"Error after saving {os.path.basename(key)}: {e}")
+
+    def pending(self, path) -> bool:
+        """Une écriture de `path` est programmée ou en cours."""
+        key = os.fspath(path)
+        return key in self._pending or key in self._writing
+
+    async def flush(self) -> None:
+        """Écrit immédiatement tous les fichiers en attente."""
+        for timer in list(self._timers.values()):
+            timer.cancel()
+        self._timers.clear()
+        for key in list(self._pending):
+            await self._write(key)
+        # Écritures lancées par des tâches annulées : on attend qu'elles aboutissent
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
@@ -0,0 +1,136 @@
+# utils/stats.py
+from __future__ import annotations
+
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+
+HOUR = 3600
+DAY = 86400
+HOURLY_BUCKETS = 48   # 2 jours d'historique horaire
+DAILY_BUCKETS = 30    # 30 jours d'historique journalier
+FLUSH_INTERVAL = float(os.getenv("RENAME_STATS_FLUSH_INTERVAL", "30"))
+
+
+class RenameStats:
+    """
+    Statistiques de renommage en mémoire.
+
+    record() ne fait qu'incrémenter des compteurs : totaux, plus des seaux
+    [début, fichiers, octets] par heure et par jour (UTC) gardés dans des
+    tampons circulaires. Le fichier JSON n'est réécrit que périodiquement,
+    via le StateFileWriter partagé.
+    """
+
+    def __init__(self, path, writer, flush_interval: float = FLUSH_INTERVAL) -> None:
+        self.path = os.fspath(path)
+        self.writer = writer
+        self.flush_interval = max(1.0, float(flush_interval))
+        self.total_files = 0
+        self.total_bytes = 0
+        self.hourly: deque = deque(maxlen=HOURLY_BUCKETS)
+        self.daily: deque = deque(maxlen=DAILY_BUCKETS)
+        self._loaded = False
+        self._dirty = False
+
+    def load(self) -> None:
+        """Charge rename_stats.json (format historique accepté)."""
+        total_files, total_bytes, hourly, daily = 0, 0, [], []
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f) or {}
+                total_files = int(data.get("total_files_renamed", 0))
+                total_bytes = int(data.get("total_storage_bytes", 0))
+                hourly = [[int(b[0]), int(b[1]), int(b[2])] for b in data.get("hourly", [])]
+                daily = [[int(b[0]), int(b[1]), int(b[2])] for b in data.get("daily", [])]
+        except Exception as e:
+            # Fichier illisible ou mal formé : on repart de zéro plutôt qu'à moitié chargé
+            logging.error(f"Error loading {os.path.basename(self.path)}: {e}")
+            total_files, total_bytes, hourly, daily = 0, 0, [], []
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.hourly.clear()
+        self.daily.clear()
+        self.hourly.extend(hourly)
+        self.daily.extend(daily)
+        self._loaded = True
+
+    def _ensure_loaded(self) -> None:
+        if not self._loaded:
+            self.load()
+
+    @staticmethod
+    def _bump(buckets: deque, start: int, nbytes: int) -> None:
+        if buckets and buckets[-1][0] == start:
+            buckets[-1][1] += 1
+            buckets[-1][2] += nbytes
+        else:
+            buckets.append([start, 1, nbytes])
+
+    def record(self, file_size_bytes: int, now: float | None = None) -> None:
+        """Compte un fichier renommé (aucune I/O)."""
+        self._ensure_loaded()
+        now = time.time() if now is None else now
+        nbytes = max(0, int(file_size_bytes or 0))
+        self.total_files += 1
+        self.total_bytes += nbytes
+        self._bump(self.hourly, int(now // HOUR) * HOUR, nbytes)
+        self._bump(self.daily, int(now // DAY) * DAY, nbytes)
+        self._dirty = True
+
+    def to_dict(self) -> dict:
+        self._ensure_loaded()
+        return {
+            "total_files_renamed": self.total_files,
+            "total_storage_bytes": self.total_bytes,
+            "hourly": [list(b) for b in self.hourly],
+            "daily": [list(b) for b in self.daily],
+        }
+
+    @staticmethod
+    def _window(buckets: deque, since: int, until: float = float("inf")) -> tuple[int, int]:
+        picked = [b for b in buckets if since <= b[0] < until]
+        return sum(b[1] for b in picked), sum(b[2] for b in picked)
+
+    def trends(self, now: float | None = None) -> dict:
+        """
+        Débits récents :
+        - files_last_hour : fichiers sur la dernière heure complète
+        - files_per_hour_24h : moyenne horaire sur 24 h
+        - bytes_today : octets depuis minuit UTC
+        - bytes_per_day_7d : moyenne journalière sur 7 jours
+        """
+        self._ensure_loaded()
+        now = time.time() if now is None else now
+        hour = int(now // HOUR) * HOUR
+        day = int(now // DAY) * DAY
+        files_1h, _ = self._window(self.hourly, hour - HOUR, hour)
+        files_24h, _ = self._window(self.hourly, hour - 23 * HOUR)
+        _, bytes_today = self._window(self.daily, day)
+        _, bytes_7d = self._window(self.daily, day - 6 * DAY)
+        return {
+            "files_last_hour": files_1h,
+            "files_per_hour_24h": files_24h / 24,
+            "bytes_today": bytes_today,
+            "bytes_per_day_7d": bytes_7d / 7,
+        }
+
+    def flush(self) -> None:
+        """Programme l'écriture du JSON si quelque chose a changé."""
+        if not self._dirty:
+            return
+        self._dirty = False
+        self.writer.schedule(self.path, self.to_dict())
+
+    async def run(self) -> None:
+        """Tâche de fond : flush() toutes les `flush_interval` secondes."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Rename stats flush failed: {e}")
@@ -0,0 +1,379 @@
+# utils/transfer.py
+from __future__ import annotations
+
+import os
+import random
+import asyncio
+import hashlib
+import inspect
+import logging
+import threading
+
+from telethon import errors
+from telethon.errors import FloodWaitError
+from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+from telethon.tl.types import InputFile, InputFileBig
+
+PART_SIZE = 512 * 1024                 # taille maximale d'une part d'upload
+BIG_FILE_THRESHOLD = 10 * 1024 * 1024  # au-delà : SaveBigFilePart / InputFileBig
+PIPE_BUFFER_PARTS = int(os.getenv("STREAM_PIPE_BUFFER_PARTS", "8"))
+# Upload : parts envoyées en parallèle, et nouvelles tentatives par part
+UPLOAD_WINDOW = int(os.getenv("UPLOAD_WINDOW", "8"))
+PART_RETRIES = 3
+# Durée de réutilisation d'une miniature uploadée (Telegram finit par l'oublier)
+THUMB_HANDLE_TTL = float(os.getenv("THUMB_HANDLE_TTL", "21600"))
+# Téléchargement parallèle : nombre de flux simultanés, taille des segments
+# distribués aux flux (en parts) et taille minimale pour en valoir la peine
+DOWNLOAD_CONNECTIONS = int(os.getenv("DOWNLOAD_CONNECTIONS", "4"))
+SEGMENT_PARTS = 8
+PARALLEL_MIN_SIZE = int(os.getenv("PARALLEL_DOWNLOAD_MIN_MB", "20")) * 1024 * 1024
+
+
+async def _notify(callback, current: int, total: int) -> None:
+    if callback is None:
+        return
+    result = callback(current, total)
+    if inspect.isawaitable(result):
+        await result
+
+
+async def _rechunk(chunks, part_size: int):
+    """Redécoupe un flux de blocs quelconques en parts de `part_size` (dernière part plus courte)."""
+    buf = bytearray()
+    async for chunk in chunks:
+        buf += chunk
+        while len(buf) >= part_size:
+            yield bytes(buf[:part_size])
+            del buf[:part_size]
+    if buf:
+        yield bytes(buf)
+
+
+async def _save_part(client, file_id: int, index: int, total_parts: int, data: bytes,
+                     is_big: bool, retries: int) -> None:
+    """Envoie une part ; FloodWait attendu, autres erreurs réessayées avec backoff."""
+    attempt = 0
+    while True:
+        try:
+            if is_big:
+                request = SaveBigFilePartRequest(file_id, index, total_parts, data)
+            else:
+                request = SaveFilePartRequest(file_id, index, data)
+            if await client(request):
+                return
+            raise RuntimeError(f"Telegram refused upload part {index}")
+        except FloodWaitError as e:
+            if attempt >= retries:
+                raise
+            await asyncio.sleep(min(e.seconds, 60))
+        except Exception as e:
+            if attempt >= retries:
+                raise
+            logging.warning(f"Upload part {index} failed ({e}), retry {attempt + 1}/{retries}")
+            await asyncio.sleep(0.5 * 2 ** attempt)
+        attempt += 1
+
+
+async def upload_stream(client, chunks, file_size: int | None, file_name: str,
+                        part_size: int = PART_SIZE, window: int = UPLOAD_WINDOW,
+                        retries: int = PART_RETRIES, progress_callback=None):
+    """
+    Envoie un flux asynchrone de blocs comme fichier Telegram.
+
+    Jusqu'à `window` parts sont en vol en même temps, chacune réessayée
+    `retries` fois. Renvoie l'InputFile/InputFileBig à passer à send_file().
+
+    file_size=None : taille inconnue (sortie d'ffmpeg). Upload « streamé »
+    en SaveBigFilePart avec file_total_parts=-1, la dernière part portant
+    le vrai total ; progress_callback n'est alors pas appelé.
+    """
+    streamed = file_size is None
+    if not streamed:
+        file_size = int(file_size)
+        if file_size <= 0:
+            raise ValueError("file_size must be positive")
+    file_id = random.getrandbits(63)
+    is_big = streamed or file_size > BIG_FILE_THRESHOLD
+    total_parts = -1 if streamed else (file_size + part_size - 1) // part_size
+    md5 = None if is_big else hashlib.md5()
+    window = max(1, int(window))
+    in_flight: dict[asyncio.Future, int] = {}
+    index = read = sent = 0
+    held: bytes | None = None  # mode streamé : on ne sait qu'une part est la dernière qu'à la fin
+
+    def dispatch(part_index: int, part: bytes, total: int) -> None:
+        task = asyncio.ensure_future(
+            _save_part(client, file_id, part_index, total, part, is_big, retries)
+        )
+        in_flight[task] = len(part)
+
+    async def reap(return_when):
+        nonlocal sent
+        done, _ = await asyncio.wait(in_flight, return_when=return_when)
+        for task in done:
+            nbytes = in_flight.pop(task)
+            task.result()  # relance l'erreur de la part après ses retries
+            sent += nbytes
+        if not streamed:
+            await _notify(progress_callback, sent, file_size)
+
+    try:
+        async for part in _rechunk(chunks, part_size):
+            if md5 is not None:
+                md5.update(part)
+            if streamed:
+                if held is not None:
+                    dispatch(index - 1, held, -1)
+                held = part
+            else:
+                dispatch(index, part, total_parts)
+            index += 1
+            read += len(part)
+            if len(in_flight) >= window:
+                await reap(asyncio.FIRST_COMPLETED)
+        while in_flight:
+            await reap(asyncio.FIRST_COMPLETED)
+        if streamed:
+            if held is None:
+                raise ValueError("Nothing to upload: empty stream")
+            total_parts = index
+            dispatch(index - 1, held, total_parts)
+            await reap(asyncio.ALL_COMPLETED)
+    finally:
+        for task in in_flight:
+            task.cancel()
+        if in_flight:
+            await asyncio.gather(*in_flight, return_exceptions=True)
+    if not streamed and (index != total_parts or read != file_size):
+        raise ValueError(f"Stream ended at {read}/{file_size} bytes ({index}/{total_parts} parts)")
+    if is_big:
+        return InputFileBig(file_id, total_parts, file_name)
+    return InputFile(file_id, total_parts, file_name, md5.hexdigest())
+
+
+async def _read_file(path, part_size: int = PART_SIZE):
+    f = await asyncio.to_thread(open, path, "rb")
+    try:
+        while True:
+            data = await asyncio.to_thread(f.read, part_size)
+            if not data:
+                return
+            yield data
+    finally:
+        await asyncio.to_thread(f.close)
+
+
+async def upload_file_parallel(client, path, file_name: str, window: int = UPLOAD_WINDOW,
+                               retries: int = PART_RETRIES, progress_callback=None):
+    """Upload d'un fichier local, `window` parts en parallèle ; renvoie InputFileBig (ou InputFile si < 10 Mo)."""
+    return await upload_stream(
+        client, _read_file(path), os.path.getsize(path), file_name,
+        window=window, retries=retries, progress_callback=progress_callback,
+    )
+
+
+async def iter_document(client, document, file_size: int, offset: int = 0, limit: int | None = None):
+    """Parts de PART_SIZE d'un document Telegram, à partir de `offset` (multiple de PART_SIZE)."""
+    async for chunk in client.iter_download(
+        document, offset=offset, limit=limit, chunk_size=PART_SIZE,
+        request_size=PART_SIZE, file_size=file_size,
+    ):
+        yield bytes(chunk)
+
+
+async def pipe_document(client, document, file_size: int, file_name: str,
+                        buffer_parts: int = PIPE_BUFFER_PARTS, progress_callback=None):
+    """
+    Recopie un document Telegram sans fichier temporaire.
+
+    iter_download() remplit une file bornée à `buffer_parts` parts, que
+    upload_stream() vide au fur et à mesure : téléchargement et upload se
+    chevauchent, avec au plus buffer_parts * PART_SIZE octets en mémoire.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, int(buffer_parts)))
+    done = object()
+
+    async def producer():
+        try:
+            async for chunk in iter_document(client, document, file_size):
+                await queue.put(chunk)
+        except Exception as e:
+            await queue.put(e)
+            return
+        await queue.put(done)
+
+    async def chunks():
+        while True:
+            item = await queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    task = asyncio.ensure_future(producer())
+    try:
+        return await upload_stream(
+            client, chunks(), file_size, file_name, progress_callback=progress_callback
+        )
+    finally:
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+
+class _PositionalWriter:
+    """Écritures à un offset donné dans un fichier préalloué (pwrite, sinon seek+write verrouillé)."""
+
+    def __init__(self, path, size: int) -> None:
+        self._f = open(path, "wb")
+        self._lock = threading.Lock()
+        try:
+            if hasattr(os, "posix_fallocate") and size:
+                os.posix_fallocate(self._f.fileno(), 0, size)
+            else:
+                self._f.truncate(size)
+        except OSError:
+            self._f.truncate(size)
+
+    def write(self, offset: int, data: bytes) -> None:
+        if hasattr(os, "pwrite"):
+            os.pwrite(self._f.fileno(), data, offset)
+            return
+        with self._lock:
+            self._f.seek(offset)
+            self._f.write(data)
+
+    def close(self) -> None:
+        self._f.close()
+
+
+async def download_parallel(client, document, path, file_size: int,
+                            connections: int = DOWNLOAD_CONNECTIONS, progress_callback=None) -> str:
+    """
+    Télécharge `document` dans `path` par segments, sur plusieurs flux en parallèle.
+
+    Le fichier est préalloué à `file_size` ; chaque segment de SEGMENT_PARTS
+    parts est écrit à son offset, donc l'ordre d'arrivée n'importe pas.
+    Les flux se partagent une file de segments (les plus rapides en prennent
+    plus) et progress_callback reçoit le total cumulé.
+    """
+    file_size = int(file_size)
+    total_parts = (file_size + PART_SIZE - 1) // PART_SIZE
+    segments: asyncio.Queue = asyncio.Queue()
+    for first in range(0, total_parts, SEGMENT_PARTS):
+        segments.put_nowait((first, min(SEGMENT_PARTS, total_parts - first)))
+    dc_id = getattr(document, "dc_id", None)
+    writer = await asyncio.to_thread(_PositionalWriter, path, file_size)
+    received = 0
+
+    async def worker():
+        nonlocal received
+        while True:
+            try:
+                first, count = segments.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            offset = first * PART_SIZE
+            async for chunk in client.iter_download(
+                document, offset=offset, limit=count, chunk_size=PART_SIZE,
+                request_size=PART_SIZE, file_size=file_size, dc_id=dc_id,
+            ):
+                await asyncio.to_thread(writer.write, offset, bytes(chunk))
+                offset += len(chunk)
+                received += len(chunk)
+                await _notify(progress_callback, received, file_size)
+
+    tasks = [asyncio.ensure_future(worker()) for _ in range(max(1, min(int(connections), segments.qsize())))]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.to_thread(writer.close)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        raise
+    await asyncio.to_thread(writer.close)
+    if received != file_size:
+        os.remove(path)
+        raise IOError(f"Parallel download got {received}/{file_size} bytes")
+    return os.fspath(path)
+
+
+# Erreurs typées de Telethon : leur .message vaut 'BAD_REQUEST', seul le type
+# permet de les reconnaître (getattr : toutes n'existent pas dans chaque version)
+_EXPIRED_UPLOAD_ERRORS = tuple(
+    cls for cls in (
+        getattr(errors, name, None) for name in (
+            "FilePartMissingError", "FilePart0MissingError", "FilePartsInvalidError",
+        )
+    ) if cls is not None
+)
+
+def is_expired_upload_error(error) -> bool:
+    """Telegram a oublié un fichier uploadé (FILE_PART_n_MISSING, FILE_PARTS_INVALID)."""
+    return bool(_EXPIRED_UPLOAD_ERRORS) and isinstance(error, _EXPIRED_UPLOAD_ERRORS)
+
+
+def _file_digest(path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class ThumbCache:
+    """
+    Handles InputFile des miniatures déjà uploadées, par utilisateur.
+
+    Clé : (user_id, sha1 du fichier). Le hash n'est recalculé que si la
+    taille ou le mtime changent. Un handle expire après `ttl` secondes, ou
+    dès que l'appelant signale un refus de Telegram via invalidate().
+    """
+
+    def __init__(self, ttl: float = THUMB_HANDLE_TTL) -> None:
+        self.ttl = float(ttl)
+        self.uploads = 0
+        self.hits = 0
+        self._handles: dict[int, tuple[str, object, float]] = {}
+        self._digests: dict[str, tuple[int, int, str]] = {}
+        self._locks: dict[int, asyncio.Lock] = {}
+
+    async def _digest(self, path: str) -> str | None:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        known = self._digests.get(path)
+        if known and known[0] == st.st_mtime_ns and known[1] == st.st_size:
+            return known[2]
+        digest = await asyncio.to_thread(_file_digest, path)
+        self._digests[path] = (st.st_mtime_ns, st.st_size, digest)
+        return digest
+
+    async def get(self, client, user_id: int, path):
+        """InputFile de la miniature (uploadée au besoin), ou None si l'utilisateur n'en a pas."""
+        path = os.fspath(path)
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            digest = await self._digest(path)
+            if digest is None:
+                self.invalidate(user_id)
+                return None
+            loop = asyncio.get_running_loop()
+            entry = self._handles.get(user_id)
+            if entry and entry[0] == digest and loop.time() < entry[2]:
+                self.hits += 1
+                return entry[1]
+            handle = await client.upload_file(path, file_name=os.path.basename(path))
+            self.uploads += 1
+            self._handles[user_id] = (digest, handle, loop.time() + self.ttl)
+            return handle
+
+    def invalidate(self, user_id: int) -> None:
+        self._handles.pop(user_id, None)
@@ -0,0 +1,259 @@
+# utils/userstore.py
+from __future__ import annotations
+
+import os
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime
+import aiosqlite
+
+DB_PATH = os.getenv("USER_DB_PATH", "users.db")
+LEGACY_PREFS_PATH = "user_preferences.json"
+LEGACY_USAGE_PATH = "user_usage.json"
+# last_active n'est réécrit en base qu'au plus une fois par intervalle et par utilisateur
+TOUCH_INTERVAL = float(os.getenv("USER_TOUCH_INTERVAL", "60"))
+
+# Champs persistés ; les autres clés d'une session (ex: awaiting_custom_text)
+# restent en mémoire uniquement.
+PREF_DEFAULTS = {'custom_text': '', 'text_position': 'end', 'clean_tags': True}
+
+_SQL_SELECT_ALL = "SELECT user_id, custom_text, text_position, clean_tags FROM users"
+_SQL_SELECT_ONE = (
+    "SELECT user_id, custom_text, text_position, clean_tags FROM users WHERE user_id=?"
+)
+_SQL_UPSERT = (
+    "INSERT INTO users (user_id, custom_text, text_position, clean_tags) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET custom_text = excluded.custom_text, "
+    "text_position = excluded.text_position, clean_tags = excluded.clean_tags"
+)
+_SQL_COUNT_CUSTOM_TEXT = "SELECT COUNT(*) FROM users WHERE custom_text != ''"
+_SQL_TOUCH = (
+    "INSERT INTO users (user_id, first_seen, last_active) VALUES (?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET last_active = MAX(COALESCE(last_active, 0), excluded.last_active)"
+)
+_SQL_REGISTER = "INSERT OR IGNORE INTO users (user_id) VALUES (?)"
+_SQL_COUNT_USERS = "SELECT COUNT(*) FROM users"
+_SQL_COUNT_ACTIVE_SINCE = "SELECT COUNT(*) FROM users WHERE last_active >= ?"
+
+async def _ensure_column(db: aiosqlite.Connection, table: str, column: str, decl: str) -> bool:
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    cols = {row[1] for row in await cur.fetchall()}
+    await cur.close()
+    if column in cols:
+        return False
+    await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return True
+
+async def _ensure_schema(db: aiosqlite.Connection) -> bool:
+    """Crée/migre la table. Retourne True si la colonne last_active vient d'être ajoutée."""
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            custom_text TEXT NOT NULL DEFAULT '',
+            text_position TEXT NOT NULL DEFAULT 'end',
+            clean_tags INTEGER NOT NULL DEFAULT 1
+        )
+        """
+    )
+    await _ensure_column(db, "users", "first_seen", "REAL")
+    added = await _ensure_column(db, "users", "last_active", "REAL")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active)")
+    await db.commit()
+    return added
+
+def _row_to_prefs(row) -> dict:
+    return {
+        'custom_text': row[1] or '',
+        'text_position': row[2] or 'end',
+        'clean_tags': bool(row[3]),
+    }
+
+
+class UserStore:
+    """
+    Registre des utilisateurs en SQLite, une ligne par utilisateur :
+    préférences et activité (first_seen, last_active indexé).
+
+    Les préférences sont chargées au démarrage dans `cache` (dict
+    user_id -> session) ; le bot lit ce dict directement et save() ne
+    réécrit que la ligne de l'utilisateur modifié. get() relit la base si
+    un user_id manque du cache. touch() tient last_active à jour.
+    """
+
+    def __init__(
+        self,
+        db_path: str = DB_PATH,
+        legacy_path: str = LEGACY_PREFS_PATH,
+        legacy_usage_path: str = LEGACY_USAGE_PATH,
+        touch_interval: float = TOUCH_INTERVAL,
+    ) -> None:
+        self.db_path = db_path
+        self.legacy_path = legacy_path
+        self.legacy_usage_path = legacy_usage_path
+        self.touch_interval = max(0.0, float(touch_interval))
+        self.cache: dict[int, dict] = {}
+        # True au premier démarrage avec la colonne last_active : l'appelant
+        # peut alors enregistrer les utilisateurs connus d'autres sources
+        self.needs_backfill = False
+        self._db: aiosqlite.Connection | None = None
+        self._lock = asyncio.Lock()
+        self._touched: dict[int, float] = {}
+
+    async def open(self) -> None:
+        """Ouvre la base, importe l'ancien JSON si besoin et charge tout le cache."""
+        async with self._lock:
+            if self._db is not None:
+                return
+            folder = os.path.dirname(self.db_path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            db = await aiosqlite.connect(self.db_path)
+            await db.execute("PRAGMA journal_mode=WAL")
+            await db.execute("PRAGMA synchronous=NORMAL")
+            self.needs_backfill = await _ensure_schema(db)
+            self._db = db
+            await self._import_legacy()
+            if self.needs_backfill:
+                await self._import_legacy_usage()
+            cur = await db.execute(_SQL_SELECT_ALL)
+            rows = await cur.fetchall()
+            await cur.close()
+            for row in rows:
+                self.cache.setdefault(int(row[0]), {}).update(_row_to_prefs(row))
+
+    async def close(self) -> None:
+        async with self._lock:
+            if self._db is not None:
+                await self._db.close()
+                self._db = None
+
+    async def _import_legacy(self) -> None:
+        # Migration unique depuis user_preferences.json (table vide uniquement)
+        if not os.path.exists(self.legacy_path):
+            return
+        cur = await self._db.execute("SELECT COUNT(*) FROM users")
+        row = await cur.fetchone()
+        await cur.close()
+        if row and row[0]:
+            return
+        try:
+            with open(self.legacy_path, 'r') as f:
+                prefs = json.load(f)
+            rows = []
+            for user_id_str, data in prefs.items():
+                p = {**PREF_DEFAULTS, **(data or {})}
+                rows.append((int(user_id_str), p['custom_text'] or '',
+                             p['text_position'] or 'end', int(bool(p['clean_tags']))))
+            await self._db.executemany(_SQL_UPSERT, rows)
+            await self._db.commit()
+            logging.info(f"Imported {len(rows)} users from {self.legacy_path}")
+        except Exception as e:
+            logging.error(f"Error importing {self.legacy_path}: {e}")
+
+    async def _import_legacy_usage(self) -> None:
+        # Utilisateurs et dernière activité connus de l'ancien user_usage.json
+        if not os.path.exists(self.legacy_usage_path):
+            return
+        try:
+            with open(self.legacy_usage_path, 'r') as f:
+                usage = json.load(f)
+            rows = []
+            for user_id_str, data in usage.items():
+                last = (data or {}).get('last_file_time')
+                ts = None
+                if last:
+                    try:
+                        ts = datetime.fromisoformat(last).timestamp()
+                    except ValueError:
+                        ts = None
+                rows.append((int(user_id_str), ts, ts))
+            await self._db.executemany(
+                "INSERT INTO users (user_id, first_seen, last_active) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET last_active = excluded.last_active",
+                rows,
+            )
+            await self._db.commit()
+            logging.info(f"Imported {len(rows)} users from {self.legacy_usage_path}")
+        except Exception as e:
+            logging.error(f"Error importing {self.legacy_usage_path}: {e}")
+
+    async def get(self, user_id: int) -> dict:
+        """Session de l'utilisateur (cache, sinon lecture de sa ligne)."""
+        if user_id in self.cache:
+            return self.cache[user_id]
+        if self._db is None:
+            await self.open()
+        cur = await self._db.execute(_SQL_SELECT_ONE, (user_id,))
+        row = await cur.fetchone()
+        await cur.close()
+        session = self.cache.setdefault(user_id, {})
+        if row:
+            for k, v in _row_to_prefs(row).items():
+                session.setdefault(k, v)
+        return session
+
+    async def save(self, user_id: int) -> None:
+        """Écrit uniquement la ligne de cet utilisateur."""
+        if self._db is None:
+            await self.open()
+        p = {**PREF_DEFAULTS, **self.cache.get(user_id, {})}
+        await self._db.execute(
+            _SQL_UPSERT,
+            (user_id, p['custom_text'] or '', p['text_position'] or 'end', int(bool(p['clean_tags']))),
+        )
+        await self._db.commit()
+
+    async def touch(self, user_id: int, now: float | None = None) -> None:
+        """Marque l'utilisateur actif ; écrit au plus une fois par touch_interval."""
+        now = time.time() if now is None else now
+        if now - self._touched.get(user_id, 0.0) < self.touch_interval:
+            return
+        self._touched[user_id] = now
+        if self._db is None:
+            await self.open()
+        await self._db.execute(_SQL_TOUCH, (user_id, now, now))
+        await self._db.commit()
+
+    async def register_many(self, user_ids) -> None:
+        """Ajoute des utilisateurs connus ailleurs, sans toucher aux lignes existantes."""
+        if self._db is None:
+            await self.open()
+        await self._db.executemany(_SQL_REGISTER, [(int(uid),) for uid in user_ids])
+        await self._db.commit()
+        self.needs_backfill = False
+
+    async def count_users(self) -> int:
+        if self._db is None:
+            await self.open()
+        cur = await self._db.execute(_SQL_COUNT_USERS)
+        row = await cur.fetchone()
+        await cur.close()
+        return int(row[0]) if row else 0
+
+    async def count_active_since(self, seconds: float) -> int:
+        """Utilisateurs actifs sur les `seconds` dernières secondes (index sur last_active)."""
+        if self._db is None:
+            await self.open()
+        cur = await self._db.execute(_SQL_COUNT_ACTIVE_SINCE, (time.time() - seconds,))
+        row = await cur.fetchone()
+        await cur.close()
+        return int(row[0]) if row else 0
+
+    async def user_ids(self) -> set[int]:
+        if self._db is None:
+            await self.open()
+        cur = await self._db.execute("SELECT user_id FROM users")
+        rows = await cur.fetchall()
+        await cur.close()
+        return {int(r[0]) for r in rows}
+
+    async def count_custom_text(self) -> int:
+        if self._db is None:
+            await self.open()
+        cur = await self._db.execute(_SQL_COUNT_CUSTOM_TEXT)
+        row = await cur.fetchone()
+        await cur.close()
+        return int(row[0]) if row else 0